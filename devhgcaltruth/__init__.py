@@ -112,6 +112,16 @@ HGCAL_ZMAX_POS = max(Z_POS_LAYERS)
 HGCAL_ZMIN_NEG = min(Z_NEG_LAYERS)
 HGCAL_ZMAX_NEG = max(Z_NEG_LAYERS)
 
+# Boundaries halfway between consecutive layers, for layer lookups
+_Z_LAYER_BOUNDARIES = 0.5 * (np.array(Z_POS_LAYERS[1:]) + np.array(Z_POS_LAYERS[:-1]))
+
+def layer_index(z):
+    """
+    Returns the index in Z_POS_LAYERS of the layer nearest to abs(z), for both endcaps.
+    Works on scalars and arrays.
+    """
+    return np.searchsorted(_Z_LAYER_BOUNDARIES, np.abs(z))
+
 
 G4DecayProcessType = {
     201 : 'DECAY',
@@ -177,29 +187,18 @@ G4PROCESS = {
 
 def digitize(n, base=10):
     """
-    Splits (array of) integer(s) into digits (broadcastable)
+    Splits (array of) integer(s) into digits (broadcastable); see pdg.digits
     """
-    digits = []
-    while not(np.all(n == 0)):
-        n, d = np.divmod(n, base)
-        digits.append(d)
-    return np.array(digits)
+    return pdg.digits(n, base=base)
 
 def is_hadron(pdgid):
-    return np.abs(pdgid) >= 111
+    return pdg.is_hadron(pdgid)
 
 def is_meson(pdgid):
-    pdgid = np.abs(pdgid)
-    digits = digitize(pdgid)
-    if digits.shape[1] >= 3:
-        return (digits[3] == 0) & (digits[2] > 0)
-    elif digits.shape[1] == 2:
-        return digits[2] > 0
-    else:
-        return np.zeros(pdgid.shape[0]).astype(np.bool)
+    return pdg.is_meson(pdgid)
 
 def is_baryon(pdgid):
-    return is_hadron(pdgid) & ~is_meson(pdgid)
+    return pdg.is_baryon(pdgid)
 
 PDGID_COLORS = {
     0 : 'xkcd:purple', # undefined
@@ -211,65 +210,84 @@ PDGID_COLORS = {
 
 def color_pdgid(pdgid, default_value='xkcd:gray'):
     """
-    Should work for numpy arrays, will NOT work for JaggedArrays
-    https://stackoverflow.com/a/16993364/9209944
+    Works for scalars, numpy arrays and jagged arrays; see pdg.color_pdgid
     """
-    if hasattr(pdgid, 'shape'):
-        pdgid = np.abs(pdgid)
-        # Get only the unique values for which to call the dict.get method,
-        # and get the indices per unique value to reconstruct later
-        u, inv = np.unique(pdgid, return_inverse=True)
-        # Do dict mapping, and reconstruct to shape of pdgid
-        color = np.array([PDGID_COLORS.get(x, default_value) for x in u])[inv].reshape(pdgid.shape)
-    else:
-        color = PDGID_COLORS.get(abs(pdgid), default_value)
-    return color
-
-_all_colors = list(mcd.XKCD_COLORS.keys())
-_assigned_colors = {}
-np.random.seed(44)
-def color_for_id(i):
-    global _assigned_colors, _all_colors
-    if not i in _assigned_colors:
-        i_picked_color = np.random.randint(len(_all_colors))
-        _assigned_colors[i] = _all_colors.pop(i_picked_color)
-        if len(_all_colors) == 0:
-            logger.warning('Out of colors: resetting color wheel')
-            _all_colors = list(mcd.XKCD_COLORS.keys())
-    return _assigned_colors[i]
+    return pdg.color_pdgid(pdgid, default_value)
+
+# Fixed palette, shuffled once with a local RNG so the global numpy RNG is not touched
+COLOR_PALETTE = np.array(list(mcd.XKCD_COLORS.values()))
+COLOR_PALETTE = COLOR_PALETTE[np.random.RandomState(44).permutation(len(COLOR_PALETTE))]
+_color_seed = 44
+
+def hash_ids(ids, seed=0):
+    '''
+    Deterministic 64-bit hash (splitmix64 finalizer) of integer ids. Works on scalars
+    and arrays, and gives the same values in every process (unlike the builtin hash).
+    Integral floats are hashed like ints; other ids are hashed via the crc32 of their str.
+    '''
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'f' and np.all(np.mod(ids, 1.) == 0.):
+        ids = ids.astype(np.int64)
+    elif ids.dtype.kind not in 'iub':
+        import zlib
+        ids = np.vectorize(lambda x: zlib.crc32(str(x).encode()), otypes=[np.int64])(ids)
+    with np.errstate(over='ignore'):
+        x = ids.astype(np.int64).astype(np.uint64) ^ np.uint64(seed)
+        x = x + np.uint64(0x9e3779b97f4a7c15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+def color_for_id(i, seed=None, palette=COLOR_PALETTE):
+    '''
+    Returns a color for an id (or an array of colors for an array of ids).
+    Stateless: the color only depends on the id, the seed and the palette.
+    '''
+    if seed is None: seed = _color_seed
+    colors = palette[hash_ids(i, seed) % np.uint64(len(palette))]
+    return colors if np.ndim(i) else str(colors)
 
 def shuffle_colors(seed=1001):
     '''
-    Shuffles only currently assigned colors
+    Changes the colors color_for_id assigns (to the ones for `seed`).
+    Note that processes that do not inherit this setting (e.g. spawned ones) need to
+    call this too.
     '''
-    np.random.seed(seed)
-    global _assigned_colors
-    assigned_colors = _assigned_colors.values()
-    np.random.shuffle(assigned_colors)
-    for i, key in enumerate(_assigned_colors):
-        _assigned_colors[key] = assigned_colors[i]
+    global _color_seed
+    _color_seed = seed
 
 
 class IDColor:
-    '''Returns a consistent color when given the same object'''
+    '''Returns a consistent color when given the same object, in every process'''
     def __init__(self, colors=None, seed=44):
-        self.colors = list(mcd.XKCD_COLORS.values()) if colors is None else colors
-        np.random.seed(seed)
-        np.random.shuffle(self.colors)
-        self._original_colors = self.colors.copy()
-        self.assigned_colors = {}
+        self.palette = COLOR_PALETTE if colors is None else np.asarray(colors)
+        self.seed = seed
         
     def __call__(self, thing):
-        if thing in self.assigned_colors:
-            return self.assigned_colors[thing]
-        else:
-            color = self.colors.pop()
-            self.assigned_colors[thing] = color
-            if not(self.colors): self.colors = self._original_colors.copy()
-            return color
+        return color_for_id(thing, seed=self.seed, palette=self.palette)
+
 
+def _event_columns(event, prefix):
+    return {
+        k.decode()[len(prefix):] : np.asarray(event[k]).ravel()
+        for k in event.keys() if k.decode().startswith(prefix)
+        }
 
-def build_tree(event):
+
+def build_tree(event, aggregate_detids=False):
+    """
+    Builds the tree of tracks with hits of an event.
+    If `aggregate_detids` is True, simhits sharing a detid within a track are merged
+    into one hit (see trees.aggregate_hits); such hits keep the indices of their
+    original simhits in `hit.simhits`.
+    """
+    if isinstance(event, store.EventView):
+        return build_tree_from_columns(event.tracks(), event.hits(), aggregate_detids)
+    if aggregate_detids:
+        return build_tree_from_columns(
+            _event_columns(event, 'simtrack_'), _event_columns(event, 'simhit_'), True
+            )
     tracksview = uptools.Bunch.from_branches(event, [k for k in event.keys() if k.decode().startswith('simtrack_')])
     hitsview = uptools.Bunch.from_branches(event, [k for k in event.keys() if k.decode().startswith('simhit_')])
     id_to_track = {} 
@@ -310,6 +328,71 @@ def build_tree(event):
             track.hits = []
         id_to_track[track.trackid] = track
         tracks.append(track)
+    return _link_tracks(tracks, id_to_track)
+
+
+def build_tree_from_columns(tracks, hits, aggregate_detids=False):
+    """
+    Builds the tree from flat per-event arrays: `tracks` and `hits` are dicts of
+    the simtrack_ and simhit_ columns without the prefix (e.g. `EventView.tracks()`)
+    """
+    simhits = None
+    if aggregate_detids:
+        n_simhits = len(hits['trackid'])
+        hits, _, simhit_order, simhit_offsets = trees.aggregate_hits(hits)
+        # Original simhits per aggregated hit, as views of one index array
+        simhits = np.split(simhit_order, simhit_offsets[1:-1])
+        logger.debug('Aggregated %s simhits into %s hits', n_simhits, len(hits['trackid']))
+    # Group hits by trackid once, instead of selecting hits per track
+    hit_trackid = np.asarray(hits['trackid'])
+    order = np.argsort(hit_trackid, kind='stable')
+    sorted_trackid = hit_trackid[order]
+    hit_columns = {
+        k : np.asarray(hits[k])[order].tolist() for k in ['detid', 'x', 'y', 'z', 'energy']
+        }
+    if simhits is not None: hit_columns['simhits'] = [ simhits[i] for i in order ]
+    track_columns = { k : np.asarray(v).tolist() for k, v in tracks.items() }
+    begins = np.searchsorted(sorted_trackid, track_columns['trackid'], side='left').tolist()
+    ends = np.searchsorted(sorted_trackid, track_columns['trackid'], side='right').tolist()
+    id_to_track = {}
+    track_list = []
+    for i in range(len(track_columns['trackid'])):
+        track = trees.Track(
+            crossedBoundary    = bool(track_columns['crossedboundary'][i]),
+            energy             = float(track_columns['energy'][i]),
+            energyAtBoundary   = float(track_columns['boundary_energy'][i]),
+            noParent           = bool(track_columns['noparent'][i]),
+            parentTrackId      = int(track_columns['parenttrackid'][i]),
+            pdgid              = int(track_columns['pdgid'][i]),
+            trackid            = int(track_columns['trackid'][i]),
+            x                  = float(track_columns['x'][i]),
+            y                  = float(track_columns['y'][i]),
+            z                  = float(track_columns['z'][i]),
+            vertex_x           = float(track_columns['vertex_x'][i]),
+            vertex_y           = float(track_columns['vertex_y'][i]),
+            vertex_z           = float(track_columns['vertex_z'][i]),
+            xAtBoundary        = float(track_columns['boundary_x'][i]),
+            yAtBoundary        = float(track_columns['boundary_y'][i]),
+            zAtBoundary        = float(track_columns['boundary_z'][i]),
+            )
+        if track_columns['hashits'][i]:
+            track.hits = [
+                trees.Hit(
+                    hit_columns['detid'][i_hit],
+                    hit_columns['x'][i_hit],
+                    hit_columns['y'][i_hit],
+                    hit_columns['z'][i_hit],
+                    hit_columns['energy'][i_hit],
+                    parent=track,
+                    simhits=None if simhits is None else hit_columns['simhits'][i_hit]
+                    ) for i_hit in range(begins[i], ends[i])
+                ]
+        id_to_track[track.trackid] = track
+        track_list.append(track)
+    return _link_tracks(track_list, id_to_track)
+
+
+def _link_tracks(tracks, id_to_track):
     # Set parents and children
     root = trees.Track(root=True)
     for i_track, track in enumerate(tracks):
@@ -333,6 +416,12 @@ def build_tree(event):
 
 
 def split_endcaps(root, flip=False):
+    """
+    Splits a tree in the trees of the positive and negative endcap. If root is a
+    store.EventView, returns two views of the columns instead (see
+    EventView.split_endcaps), which can be passed to build_tree.
+    """
+    if isinstance(root, store.EventView): return root.split_endcaps(flip)
     pos = trees.Track(root=True, z=0.001)
     neg = trees.Track(root=True, z=-0.001)
     for track in root.children:
@@ -348,4 +437,12 @@ def split_endcaps(root, flip=False):
 
 
 from . import trees
-from . import _plotly as plotly
\ No newline at end of file
+from . import _plotly as plotly
+from . import store
+from . import pdg
+from . import kinematics
+from . import layers
+from . import association
+from . import summary
+from . import metrics
+from . import criteria
\ No newline at end of file
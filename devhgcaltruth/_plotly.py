@@ -1,16 +1,14 @@
 import numpy as np, uuid
 import devhgcaltruth as ht
+logger = ht.logger
 
-def plotly_tree(tree, colorwheel=None, noinfo=False, draw_tracks=True):
+def _plotly_tree_header(all_hits):
+    """
+    Returns the HGCAL front face trace and the info dict (ranges and energy scale)
+    for an (N, 4) array of all hits in the event
+    """
     import plotly.graph_objects as go
-    data = []
-    info = {}
-    if colorwheel is None: colorwheel = ht.IDColor()
-
-    all_hits = tree.nphits_recursively()
     all_energy = all_hits[:,3]
-    energy_scale = 20./np.average(all_energy)
-    
     xmin=np.min(all_hits[:,0])
     xmax=np.max(all_hits[:,0])
     ymin=np.min(all_hits[:,1])
@@ -21,10 +19,10 @@ def plotly_tree(tree, colorwheel=None, noinfo=False, draw_tracks=True):
         'xmin' : xmin, 'xmax' : xmax,
         'ymin' : ymin, 'ymax' : ymax,
         'zmin' : zmin, 'zmax' : zmax,
+        'energy_scale' : 20./np.average(all_energy)
         }
-
     # Draw HGCAL front face
-    data.append(go.Scatter3d(
+    data = [go.Scatter3d(
         x=[320.5 for i in range(4)], y=[xmin, xmax, xmax, xmin], z=[ymin, ymin, ymax, ymax],
         mode='lines',
         surfaceaxis=0,
@@ -33,19 +31,123 @@ def plotly_tree(tree, colorwheel=None, noinfo=False, draw_tracks=True):
         name='HGCAL front',
         hoverinfo='skip',
         visible='legendonly'
-        ))
+        )]
+    return data, info
+
+
+LOD_POINT_BUDGET = 20000
+
+def lod_aggregate(hits, index, point_budget=LOD_POINT_BUDGET, cell=1., layer=None):
+    """
+    Level-of-detail reduction of an (N, 4) array of hits (x, y, z, energy), where
+    index is the cluster index per hit.
+    Hits are aggregated per (cluster, layer, transverse voxel) into their energy-weighted
+    position and summed energy. The voxel size starts at `cell` cm and is doubled until
+    at most `point_budget` points remain; beyond per-layer summaries, layers are grouped.
+    The total energy and the energy-weighted centroid of every cluster are preserved.
+    Returns the aggregated (M, 4) hits and cluster index (sorted by cluster index), and
+    the number of original hits per aggregated point.
+    A precomputed layer index per hit (e.g. ht.layers.LayerProfiles.layer) can be passed.
+    """
+    hits = np.asarray(hits, dtype=np.float64).reshape((-1, 4))
+    index = np.asarray(index)
+    if len(hits) <= point_budget:
+        return hits, index, np.ones(len(hits), dtype=np.int64)
+    if layer is None: layer = ht.layer_index(hits[:,2])
+    xy = hits[:,:2] - hits[:,:2].min(axis=0)
+    extent = xy.max()
+    group = 1
+    n_layers = len(ht.Z_POS_LAYERS) + 1
+    while True:
+        # Pack (cluster, layer, ix, iy) into one int64 key; a 1D unique is much faster
+        n_cells = int(extent // cell) + 1
+        keys = (
+            (index.astype(np.int64) * n_layers + layer // group) * n_cells
+            + (xy[:,0] // cell).astype(np.int64)
+            ) * n_cells + (xy[:,1] // cell).astype(np.int64)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        if len(keys) <= point_budget: break
+        if cell <= extent:
+            cell *= 2.
+        elif group < len(ht.Z_POS_LAYERS):
+            group *= 2
+        else:
+            # One point per cluster left
+            break
+    inverse = inverse.ravel()
+    m = len(keys)
+    energy = np.bincount(inverse, weights=hits[:,3], minlength=m)
+    counts = np.bincount(inverse, minlength=m)
+    aggregated = np.empty((m, 4))
+    aggregated[:,3] = energy
+    has_energy = energy > 0.
+    for i in range(3):
+        weighted = np.bincount(inverse, weights=hits[:,3]*hits[:,i], minlength=m)
+        mean = np.bincount(inverse, weights=hits[:,i], minlength=m) / counts
+        aggregated[:,i] = np.where(has_energy, weighted / np.where(has_energy, energy, 1.), mean)
+    return aggregated, keys // (n_layers * n_cells * n_cells), counts
+
+
+def _lod_hits(tracks, all_hits, index, lod, full_resolution_ids=None):
+    """
+    Applies lod_aggregate to the hits of all tracks not in full_resolution_ids.
+    lod is the point budget (True for the default budget). Returns hits, index and
+    hits-per-point, sorted by track index.
+    """
+    if lod is True: lod = LOD_POINT_BUDGET
+    full = np.zeros(len(tracks), dtype=bool)
+    if full_resolution_ids is not None:
+        full_resolution_ids = set(int(i) for i in full_resolution_ids)
+        full = np.array([int(t.trackid) in full_resolution_ids for t in tracks], dtype=bool)
+    is_full = full[index]
+    aggregated, agg_index, counts = lod_aggregate(
+        all_hits[~is_full], index[~is_full], max(lod - is_full.sum(), 0)
+        )
+    all_hits = np.concatenate((all_hits[is_full], aggregated))
+    counts = np.concatenate((np.ones(is_full.sum(), dtype=np.int64), counts))
+    index = np.concatenate((index[is_full], agg_index))
+    order = np.argsort(index, kind='stable')
+    return all_hits[order], index[order], counts[order]
+
+
+def plotly_tree(
+    tree, colorwheel=None, noinfo=False, draw_tracks=True, compact=False,
+    lod=None, full_resolution_ids=None
+    ):
+    """
+    Returns plotly traces for all tracks with hits in the tree: one hits trace and
+    (if draw_tracks) one shower-axis trace per track.
+    With compact=True, all tracks are drawn in a fixed, small number of traces
+    instead (see plotly_tree_compact).
+    With lod=<point budget> (or lod=True for the default budget), the hits are
+    aggregated into at most that many points (see lod_aggregate), except for
+    the tracks with trackids in full_resolution_ids.
+    """
+    if compact:
+        return plotly_tree_compact(
+            tree, colorwheel=colorwheel, noinfo=noinfo, draw_tracks=draw_tracks,
+            lod=lod, full_resolution_ids=full_resolution_ids
+            )
+    import plotly.graph_objects as go
+    if colorwheel is None: colorwheel = ht.IDColor()
 
+    tracks, all_hits, index = ht.trees.columnar_hits(tree)
+    data, info = _plotly_tree_header(all_hits)
     info['n_tracks_with_hits'] = 0
+    counts = None
+    if lod:
+        all_hits, index, counts = _lod_hits(tracks, all_hits, index, lod, full_resolution_ids)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(index, minlength=len(tracks)))))
 
-    for track in sorted(filter(lambda t: t.nhits>0, tree.traverse()), key=lambda t: -t.nhits):
-        if track.nhits == 0: continue
+    for i_track in sorted(range(len(tracks)), key=lambda i: -tracks[i].nhits):
+        track = tracks[i_track]
         info['n_tracks_with_hits'] += 1
         visible = 'legendonly' if track.nhits <= 4 else True
 
         # First draw hits
-        hits = track.nphits()
+        hits = all_hits[offsets[i_track]:offsets[i_track+1]]
         energy = hits[:,3]            
-        sizes = np.maximum(0., np.minimum(3., np.log(energy_scale*energy)))
+        sizes = np.maximum(0., np.minimum(3., np.log(info['energy_scale']*energy)))
 
         data.append(go.Scatter3d(
             x=hits[:,2], y=hits[:,0], z=hits[:,1],
@@ -58,7 +160,9 @@ def plotly_tree(tree, colorwheel=None, noinfo=False, draw_tracks=True):
             hovertemplate=(
                 'x: %{{y:0.2f}}<br>y: %{{z:0.2f}}<br>z: %{{x:0.2f}}<br>pdgId: {}<br>'
                 .format(track.pdgid)
+                + ('hits: %{customdata}<br>' if counts is not None else '')
                 ),
+            customdata=None if counts is None else counts[offsets[i_track]:offsets[i_track+1]],
             name=str(int(track.trackid)),
             legendgroup=str(int(track.trackid)),
             visible=visible
@@ -94,17 +198,134 @@ def plotly_tree(tree, colorwheel=None, noinfo=False, draw_tracks=True):
     return data if noinfo else (data, info)
 
 
-def side_by_side_trees(tree1, tree2, colorwheel=None, **kwargs):
+def plotly_tree_compact(
+    tree, colorwheel=None, noinfo=False, draw_tracks=True, min_nhits_visible=5,
+    lod=None, full_resolution_ids=None
+    ):
+    """
+    Draws all tracks with hits in one hits trace, with per-point colors and
+    customdata (trackid, pdgid), plus the number of represented hits with lod,
+    instead of one trace per track.
+    Tracks are grouped in the legend: tracks with fewer than `min_nhits_visible` hits
+    go in a separate trace that is hidden by default (like in plotly_tree).
+    If draw_tracks, all shower axes are drawn in one lines trace (segments separated by
+    gaps), with customdata (trackid, pdgid, nhits, energyAtBoundary).
+    Note the legend cannot toggle single tracks in this mode.
+    lod and full_resolution_ids work like in plotly_tree.
+    """
+    import plotly.graph_objects as go
     if colorwheel is None: colorwheel = ht.IDColor()
-    data1, info1 = ht.plotly.plotly_tree(tree1, colorwheel=colorwheel)
-    data2 = ht.plotly.plotly_tree(tree2, colorwheel=colorwheel, noinfo=True)
-    return side_by_side_html(data1, data2, info1, **kwargs)
 
+    tracks, all_hits, index = ht.trees.columnar_hits(tree)
+    data, info = _plotly_tree_header(all_hits)
+    info['n_tracks_with_hits'] = len(tracks)
+    counts = None
+    if lod:
+        all_hits, index, counts = _lod_hits(tracks, all_hits, index, lod, full_resolution_ids)
+
+    trackids = np.array([int(t.trackid) for t in tracks], dtype=np.int64)
+    pdgids = np.array([int(t.pdgid) for t in tracks], dtype=np.int64)
+    nhits = np.array([t.nhits for t in tracks], dtype=np.int64)
+    colors = np.array([colorwheel(trackid) for trackid in trackids.tolist()], dtype=object)
+    # Per-point colors as the track index, mapped via a colorscale with one entry per track
+    # (much more compact than a color string per point)
+    colorscale = [ [i / max(len(tracks)-1, 1), c] for i, c in enumerate(colors) ]
+    color_index = dict(colorscale=colorscale, cmin=0, cmax=max(len(tracks)-1, 1))
+
+    hits32 = all_hits.astype(np.float32)
+    sizes = np.maximum(0., np.minimum(3., np.log(info['energy_scale']*all_hits[:,3]))).astype(np.float32)
+    customdata = np.stack(
+        (trackids[index], pdgids[index]) + (() if counts is None else (counts,)), axis=-1
+        ).astype(np.int32)
+    is_small = nhits[index] < min_nhits_visible
+    for select, name, visible in [
+        (~is_small, 'clusters', True),
+        (is_small, 'clusters with <{} hits'.format(min_nhits_visible), 'legendonly')
+        ]:
+        if not select.any(): continue
+        hits = hits32[select]
+        data.append(go.Scatter3d(
+            x=hits[:,2], y=hits[:,0], z=hits[:,1],
+            mode='markers',
+            marker=dict(
+                line=dict(width=0),
+                size=sizes[select],
+                color=index[select].astype(np.int32),
+                **color_index
+                ),
+            customdata=customdata[select],
+            hovertemplate=(
+                'x: %{y:0.2f}<br>y: %{z:0.2f}<br>z: %{x:0.2f}<br>'
+                'trackid: %{customdata[0]}<br>pdgId: %{customdata[1]}'
+                + ('' if counts is None else '<br>hits: %{customdata[2]}')
+                + '<extra></extra>'
+                ),
+            name=name,
+            legendgroup=name,
+            visible=visible
+            ))
 
+    if draw_tracks:
+        # All axes from boundary crossing to hit centroid in one trace;
+        # every segment is (boundary, centroid, gap)
+        n = len(tracks)
+        points = np.full((3*n, 3), np.nan)
+        points[0::3] = np.array([t.average_boundary_pos()[:3] for t in tracks]).reshape((-1, 3))
+        points[1::3] = np.array([t.centroid for t in tracks]).reshape((-1, 3))
+        segment_customdata = np.stack((
+            trackids, pdgids, nhits,
+            np.array([t.energyAtBoundary for t in tracks], dtype=np.float64)
+            ), axis=-1).repeat(3, axis=0)
+        data.append(go.Scatter3d(
+            x=points[:,2], y=points[:,0], z=points[:,1],
+            mode='lines+markers',
+            connectgaps=False,
+            marker=dict(
+                size=np.tile([4, 10, 0], n),
+                symbol=np.tile(['x', 'diamond', 'x'], n),
+                color=np.arange(n).repeat(3),
+                **color_index
+                ),
+            line=dict(
+                width=3,
+                color=np.arange(n).repeat(3),
+                **color_index
+                ),
+            customdata=segment_customdata,
+            hovertemplate=(
+                'x: %{y:.2f}<br>y: %{z:.2f}<br>z: %{x:.2f}<br>E: %{customdata[3]:.2f} GeV<br>'
+                'trackid: %{customdata[0]}<br>pdgid: %{customdata[1]}<br>nhits: %{customdata[2]}'
+                '<extra></extra>'
+                ),
+            name='shower axes',
+            legendgroup='shower axes',
+            ))
 
-def single_html(data, info=None, title=None, width=600, height=None, include_plotlyjs='cdn'):
-    import plotly.graph_objects as go
-    if height is None: height = width
+    return data if noinfo else (data, info)
+
+
+def side_by_side_data(tree1, tree2, colorwheel=None, **kwargs):
+    """
+    Returns the traces of both trees (with shared colors) and the info of the first;
+    kwargs are passed to plotly_tree
+    """
+    if colorwheel is None: colorwheel = ht.IDColor()
+    data1, info1 = plotly_tree(tree1, colorwheel=colorwheel, **kwargs)
+    data2 = plotly_tree(tree2, colorwheel=colorwheel, noinfo=True, **kwargs)
+    return data1, data2, info1
+
+
+def side_by_side_trees(
+    tree1, tree2, colorwheel=None, compact=False, binary=False, lod=None, full_resolution_ids=None,
+    **kwargs
+    ):
+    data1, data2, info1 = side_by_side_data(
+        tree1, tree2, colorwheel, compact=compact, lod=lod, full_resolution_ids=full_resolution_ids
+        )
+    return (side_by_side_html_binary if binary else side_by_side_html)(data1, data2, info1, **kwargs)
+
+
+def _scene(info=None):
     scene = dict(
         xaxis_title='z', yaxis_title='x', zaxis_title='y',
         aspectmode='cube'
@@ -115,6 +336,14 @@ def single_html(data, info=None, title=None, width=600, height=None, include_plo
             yaxis_range=[info['xmin'], info['xmax']],
             zaxis_range=[info['ymin'], info['ymax']],
             ))
+    return scene
+
+
+
+def single_html(data, info=None, title=None, width=600, height=None, include_plotlyjs='cdn'):
+    import plotly.graph_objects as go
+    if height is None: height = width
+    scene = _scene(info)
     fig = go.Figure(data=data, **(dict(layout_title_text=title) if title else {}))
     fig.update_layout(width=width, height=height, scene=scene)
     fig_html = fig.to_html(full_html=False, include_plotlyjs=include_plotlyjs)
@@ -128,16 +357,7 @@ def side_by_side_html(
     ):
     import plotly.graph_objects as go
 
-    scene = dict(
-        xaxis_title='z', yaxis_title='x', zaxis_title='y',
-        aspectmode='cube'
-        )
-    if info:
-        scene.update(dict(
-            xaxis_range=[320., info['zmax']],
-            yaxis_range=[info['xmin'], info['xmax']],
-            zaxis_range=[info['ymin'], info['ymax']],
-            ))
+    scene = _scene(info)
 
     if height is None: height = width
     fig1 = go.Figure(data=data1, **(dict(layout_title_text=title1) if title1 else {}))
@@ -161,6 +381,257 @@ def side_by_side_html(
         f'\n<script>'
         f'\nvar graphdiv_{id1} = document.getElementById("{divid1}");'
         f'\nvar graphdiv_{id2} = document.getElementById("{divid2}");'
+        + js_link_cameras(id1, id2) +
+        f'\n</script>'
+        )
+    return (html, id1, id2) if return_divids else html
+
+# ____________________________________________________
+# Binary-encoded html export
+
+class BinaryEncoder(object):
+    """
+    Collects the numeric arrays of plotly figures into base64 encoded typed-array buffers.
+    Identical arrays are stored once. The x/y/z points of all traces (of all figures
+    encoded with the same encoder) are stored once in a shared point table, and every
+    trace refers to its points via an index array. This way the hits that appear in
+    both the unmerged and the merged view of an event are only stored once.
+    """
+    def __init__(self, float_dtype=np.float32, min_length=8):
+        self.float_dtype = np.dtype(float_dtype)
+        self.min_length = min_length
+        self.buffers = {}
+
+    def to_array(self, value):
+        """
+        Returns value as a numeric np array if it is one, otherwise None
+        """
+        import base64
+        if isinstance(value, dict) and 'bdata' in value and 'dtype' in value:
+            # Plotly's own typed-array encoding
+            arr = np.frombuffer(base64.b64decode(value['bdata']), dtype=np.dtype(value['dtype']))
+            if 'shape' in value:
+                shape = value['shape']
+                if ht.is_string(shape): shape = [int(n) for n in shape.split(',')]
+                arr = arr.reshape(shape)
+            return arr
+        if isinstance(value, (list, tuple, np.ndarray)):
+            try:
+                arr = np.asarray(value)
+            except ValueError:
+                return None
+            if arr.dtype.kind in 'iuf' and arr.ndim in (1, 2): return arr
+        return None
+
+    def add(self, arr):
+        """
+        Adds an array to the buffers and returns its key
+        """
+        import hashlib, base64
+        if arr.dtype.kind == 'f':
+            arr = arr.astype(self.float_dtype)
+        elif arr.dtype.kind in 'iu' and arr.size:
+            # Smallest integer type that holds all values
+            lo, hi = arr.min(), arr.max()
+            for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+                if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+                    arr = arr.astype(dtype)
+                    break
+            else:
+                # No 64 bit integer typed arrays that plotly can use; JS numbers are doubles anyway
+                arr = arr.astype(np.float64)
+        arr = np.ascontiguousarray(arr)
+        dtype = arr.dtype.str.lstrip('<|=')
+        key = hashlib.sha1(dtype.encode() + str(arr.shape).encode() + arr.tobytes()).hexdigest()[:12]
+        if key not in self.buffers:
+            self.buffers[key] = [dtype, list(arr.shape), base64.b64encode(arr.tobytes()).decode()]
+        return key
+
+    def encode_value(self, value):
+        arr = self.to_array(value)
+        if arr is not None and len(arr) >= self.min_length:
+            return {'$buf' : self.add(arr)}
+        if isinstance(value, dict):
+            return { k : self.encode_value(v) for k, v in value.items() }
+        if isinstance(value, (list, tuple)):
+            return [ self.encode_value(v) for v in value ]
+        return value
+
+    def encode_figures(self, figures):
+        """
+        Takes a list of plotly figure dicts (e.g. fig.to_plotly_json()) and returns
+        the encoded figure dicts; the buffers are stored in self.buffers
+        """
+        # First collect all x/y/z points into one table
+        points = []
+        for fig in figures:
+            for trace in fig['data']:
+                xyz = [ self.to_array(trace.get(c, None)) for c in 'xyz' ]
+                if any(a is None or a.ndim != 1 or len(a) < self.min_length for a in xyz): continue
+                if not(len(xyz[0]) == len(xyz[1]) == len(xyz[2])): continue
+                xyz = np.stack(xyz, axis=-1).astype(self.float_dtype)
+                if np.isnan(xyz).any(): continue
+                points.append((trace, xyz))
+        encoded_points = {}
+        if points:
+            table, inverse = np.unique(np.concatenate([xyz for _, xyz in points]), axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            columns = [ self.add(table[:,i]) for i in range(3) ]
+            begin = 0
+            for trace, xyz in points:
+                index = inverse[begin:begin+len(xyz)]
+                begin += len(xyz)
+                index_key = self.add(index)
+                encoded_points[id(trace)] = {
+                    c : {'$take' : [columns[i], index_key]} for i, c in enumerate('xyz')
+                    }
+        encoded = []
+        for fig in figures:
+            data = []
+            for trace in fig['data']:
+                trace_points = encoded_points.get(id(trace), {})
+                data.append({
+                    k : trace_points[k] if k in trace_points else self.encode_value(v)
+                    for k, v in trace.items()
+                    })
+            encoded.append(dict(fig, data=data))
+        return encoded
+
+
+JS_BINARY_DECODER = """
+function htDecodeBuffer(spec){
+    const [dtype, shape, b64] = spec
+    const bin = atob(b64)
+    const bytes = new Uint8Array(bin.length)
+    for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i)
+    const types = {
+        f4: Float32Array, f8: Float64Array, i1: Int8Array, u1: Uint8Array,
+        i2: Int16Array, u2: Uint16Array, i4: Int32Array, u4: Uint32Array
+        }
+    const arr = new types[dtype](bytes.buffer)
+    if (shape.length == 2){
+        // Array of row views, e.g. for customdata
+        return Array.from({length: shape[0]}, (_, i) => arr.subarray(i*shape[1], (i+1)*shape[1]))
+        }
+    return arr
+    }
+function htResolve(obj, buffers, cache){
+    if (Array.isArray(obj)) return obj.map(v => htResolve(v, buffers, cache))
+    if (obj === null || typeof obj !== "object") return obj
+    if ("$buf" in obj){
+        if (!(obj["$buf"] in cache)) cache[obj["$buf"]] = htDecodeBuffer(buffers[obj["$buf"]])
+        return cache[obj["$buf"]]
+        }
+    if ("$take" in obj){
+        const column = htResolve({"$buf": obj["$take"][0]}, buffers, cache)
+        const index = htResolve({"$buf": obj["$take"][1]}, buffers, cache)
+        const out = new column.constructor(index.length)
+        for (let i = 0; i < index.length; i++) out[i] = column[index[i]]
+        return out
+        }
+    let out = {}
+    for (const k in obj) out[k] = htResolve(obj[k], buffers, cache)
+    return out
+    }
+"""
+
+
+def plotlyjs_html(include_plotlyjs='cdn'):
+    """
+    Returns the html to include plotly.js, with the same options as fig.to_html:
+    'cdn', True (inline), False, or a path/url to a plotly.js file
+    """
+    import plotly.offline
+    if include_plotlyjs is True:
+        return '<script type="text/javascript">' + plotly.offline.get_plotlyjs() + '</script>'
+    elif include_plotlyjs == 'cdn':
+        return (
+            '<script src="https://cdn.plot.ly/plotly-{}.min.js" charset="utf-8"></script>'
+            .format(plotly.offline.get_plotlyjs_version())
+            )
+    elif ht.is_string(include_plotlyjs) and include_plotlyjs.endswith('.js'):
+        return '<script src="{}" charset="utf-8"></script>'.format(include_plotlyjs)
+    return ''
+
+
+def binary_figures_html(figs, ids, divstyle='', include_plotlyjs='cdn', float_dtype=np.float32):
+    """
+    Returns html (divs + script) drawing the plotly figures `figs` with all arrays as
+    shared, base64 encoded typed arrays. For every figure, a JS variable graphdiv_{id}
+    is defined, like in side_by_side_html. The html ends with a '\n</script>' line.
+    """
+    import json
+    from plotly.utils import PlotlyJSONEncoder
+    encoder = BinaryEncoder(float_dtype=float_dtype)
+    encoded = encoder.encode_figures([fig.to_plotly_json() for fig in figs])
+    bufvar = 'htbuffers_' + ids[0]
+    html = [plotlyjs_html(include_plotlyjs)]
+    for id in ids:
+        html.append('<div style="{}"><div id="ht-{}"></div></div>'.format(divstyle, id))
+    html.append('<script>')
+    html.append(JS_BINARY_DECODER)
+    html.append('var {} = {};'.format(bufvar, json.dumps(encoder.buffers, separators=(',', ':'))))
+    html.append('var htcache_{} = {{}};'.format(ids[0]))
+    for id, fig in zip(ids, encoded):
+        html.append(
+            'var graphdiv_{id} = document.getElementById("ht-{id}");\n'
+            'var htfig_{id} = htResolve({fig}, {bufvar}, htcache_{id0});\n'
+            'Plotly.newPlot(graphdiv_{id}, htfig_{id}.data, htfig_{id}.layout);'
+            .format(
+                id=id, id0=ids[0], bufvar=bufvar,
+                fig=json.dumps(fig, cls=PlotlyJSONEncoder, separators=(',', ':'))
+                )
+            )
+    return '\n'.join(html) + '\n</script>'
+
+
+def single_html_binary(data, info=None, title=None, width=600, height=None, include_plotlyjs='cdn', **kwargs):
+    """
+    Like single_html, but with all arrays written as base64 encoded typed arrays
+    """
+    import plotly.graph_objects as go
+    if height is None: height = width
+    fig = go.Figure(data=data, **(dict(layout_title_text=title) if title else {}))
+    fig.update_layout(width=width, height=height, scene=_scene(info))
+    return binary_figures_html([fig], [str(uuid.uuid4())[:6]], include_plotlyjs=include_plotlyjs, **kwargs)
+
+
+def _side_by_side_figures(data1, data2, info=None, title1=None, title2=None, width=600, height=None):
+    import plotly.graph_objects as go
+    if height is None: height = width
+    scene = _scene(info)
+    fig1 = go.Figure(data=data1, **(dict(layout_title_text=title1) if title1 else {}))
+    fig1.update_layout(width=width, height=height, scene=scene)
+    fig2 = go.Figure(data=data2, **(dict(layout_title_text=title2) if title2 else {}))
+    fig2.update_layout(width=width, height=height, scene=scene)
+    return fig1, fig2
+
+
+def side_by_side_html_binary(
+    data1, data2,
+    info=None, title1=None, title2=None, width=600, height=None, include_plotlyjs='cdn',
+    return_divids=False, **kwargs
+    ):
+    """
+    Like side_by_side_html, but with all arrays written as base64 encoded typed arrays,
+    and with the hit positions of both figures stored only once
+    """
+    fig1, fig2 = _side_by_side_figures(data1, data2, info, title1, title2, width, height)
+    id1 = str(uuid.uuid4())[:6]
+    id2 = str(uuid.uuid4())[:6]
+    html = binary_figures_html(
+        [fig1, fig2], [id1, id2], divstyle='width: 47%; display: inline-block',
+        include_plotlyjs=include_plotlyjs, **kwargs
+        )
+    html = html.rsplit('\n',1)[0] + js_link_cameras(id1, id2) + '\n</script>'
+    return (html, id1, id2) if return_divids else html
+
+
+def js_link_cameras(id1, id2):
+    """
+    JS to keep the cameras of graphdiv_{id1} and graphdiv_{id2} in sync
+    """
+    return (
         f'\nvar isUnderRelayout_{id1} = false'
         f'\ngraphdiv_{id1}.on("plotly_relayout", () => {{'
         f'\n    // console.log("relayout", isUnderRelayout_{id1})'
@@ -179,101 +650,322 @@ def side_by_side_html(
         f'\n        }}'
         f'\n    isUnderRelayout_{id2} = true;'
         f'\n    }})'
-        f'\n</script>'
         )
-    return (html, id1, id2) if return_divids else html
+
 
 def js_link_legends(id1, id2, mergemap_varname='mergemap'):
+    """
+    JS that propagates visibility changes (legend clicks) of traces in graphdiv_{id2}
+    to the linked traces in graphdiv_{id1}, using the trace index map in the JS variable
+    `mergemap_varname` (see mergemap_indices). Only the affected traces are restyled.
+    """
     return f"""
-function isTrack(entry){{
-    return /^\\d+$/.test(entry["name"])
-    }}
-
-graphdiv_{id2}.on("plotly_restyle", () => {{
-    console.log('Restyling based on legend click')
-    if (graphdiv_{id2}.data.every(entry => entry["visible"] === true)){{
-        // Shortcut if everything is on
-        console.log("Detected everything turned on")
-        Plotly.restyle(graphdiv_{id1}, {{'visible' : true}}, [...Array(graphdiv_{id1}.data.length).keys()])
-        .then(() => {{isUnderRestyle_{id2} = false}})
-        }}
-    else{{
-        let visibleTracksIn_{id2} = new Set(
-            graphdiv_{id2}.data
-            .filter(entry => isTrack(entry) && (entry["visible"] === true || !("visible" in entry)))
-            .map(entry => entry["name"])
-            )
-        console.log(visibleTracksIn_{id2})
-
-        let visibleTracksIn_{id1} = new Set()
-        visibleTracksIn_{id2}.forEach(trackid => {{
-            {mergemap_varname}[trackid].forEach(merged_trackid => visibleTracksIn_{id1}.add(merged_trackid))
-            }})
-        console.log(visibleTracksIn_{id1})
-
-        updateIndicesVisible = []
-        updateIndicesInvisible = []
-        for (var i = 0; i < graphdiv_{id1}.data.length; i++) {{
-            let entry = graphdiv_{id1}.data[i]
-            if (!isTrack(entry)){{ continue }}
-            let name = entry["name"]
-            if (visibleTracksIn_{id1}.has(name)){{
-                updateIndicesVisible.push(i)
-                }}
-            else {{
-                updateIndicesInvisible.push(i)
-                }}
-            }}
-
-        // console.log(updateIndicesVisible)
-        // console.log(updateIndicesInvisible)
-
-        Plotly.restyle(graphdiv_{id1}, {{'visible' : true}}, updateIndicesVisible)
-        if (updateIndicesInvisible.length > 0){{
-            Plotly.restyle(graphdiv_{id1}, {{'visible' : "legendonly"}}, updateIndicesInvisible)
-            }}
-        }}
+graphdiv_{id2}.on("plotly_restyle", eventdata => {{
+    const update = eventdata[0]
+    if (!("visible" in update)) return
+    const traces = eventdata[1] || [...Array(graphdiv_{id2}.data.length).keys()]
+    const map = {mergemap_varname}
+    // Group the linked trace indices by their new visibility value
+    const byValue = new Map()
+    traces.forEach((i, k) => {{
+        const value = Array.isArray(update.visible) ? update.visible[k % update.visible.length] : update.visible
+        if (!byValue.has(value)) byValue.set(value, new Set())
+        const linked = byValue.get(value)
+        for (let j = map.offsets[i]; j < map.offsets[i+1]; j++) linked.add(map.indices[j])
+        }})
+    byValue.forEach((indices, value) => {{
+        if (indices.size > 0) Plotly.restyle(graphdiv_{id1}, {{"visible": value}}, [...indices])
+        }})
     }})
 """
 
-def side_by_side_unmerged_merged(unmerged, merged, outfile=None, **kwargs):
+
+def side_by_side_unmerged_merged(
+    unmerged, merged, outfile=None, compress=False, colorwheel=None, compact=False, binary=False,
+    lod=None, full_resolution_ids=None, **kwargs
+    ):
+    """
+    Side-by-side view of the unmerged and the merged tree, with linked legends:
+    toggling a merged cluster toggles the tracks it consists of.
+    Pass binary=True for the base64 encoded export, and compress=True to write
+    the outfile gzip-compressed (see write_html; '.gz' is appended if needed).
+    """
     kwargs.setdefault('title1', 'Unmerged')
     kwargs.setdefault('title2', 'Merged')
     kwargs['return_divids'] = True
-    html, id1, id2 = side_by_side_trees(unmerged, merged, **kwargs)
+    data1, data2, info = side_by_side_data(
+        unmerged, merged, colorwheel, compact=compact, lod=lod, full_resolution_ids=full_resolution_ids
+        )
+    html, id1, id2 = (side_by_side_html_binary if binary else side_by_side_html)(data1, data2, info, **kwargs)
     html = html.rsplit('\n',1)[0] # Split off last /script tag so more stuff can be added
-    html += '\n' + parse_js_mergemap(merged, f'mergemap_{id1}') + '\n\n'
+    html += '\n' + js_mergemap(mergemap_indices(merged, data1, data2), f'mergemap_{id1}') + '\n\n'
     html += js_link_legends(id1, id2, f'mergemap_{id1}')
     html += '\n</script>'
-    if outfile:
-        import os, os.path as osp
-        outdir = osp.dirname(osp.abspath(outfile))
-        if not osp.isdir(outdir): os.makedirs(outdir)
-        with open(outfile, 'w') as f:
-            f.write(html)
+    if outfile: write_html(outfile, html, compress)
     return html
 
 
-
-def parse_js_mergemap(tree, js_varname='mergemap'):
-    js = ['var ' + js_varname + ' = {']
-    for track in tree.children:
-        js.append(
-            '"{}" : {},'
-            .format(
-                track.trackid,
-                '[' + ','.join('"'+str(int(t.trackid))+'"' for t in track.merged_tracks) + ']'
-                )
-            )
-    js.append('}')
-    return '\n    '.join(js)
+def mergemap(tree):
+    """
+    Returns a dict of merged trackid -> list of the trackids merged into it (as strings)
+    """
+    return {
+        str(track.trackid) : [str(int(t.trackid)) for t in track.merged_tracks]
+        for track in tree.children
+        }
 
 
-def write_html(outfile, html):
+def parse_js_mergemap(tree, js_varname='mergemap'):
+    import json
+    return 'var ' + js_varname + ' = ' + json.dumps(mergemap(tree))
+
+
+def _join_indices(left, right):
+    return ht.association.join_indices(left, right)
+
+
+def _trace_trackids(data):
+    """
+    Trackid per trace for traces named by trackid (as in plotly_tree), -1 otherwise
+    """
+    names = [ getattr(trace, 'name', None) or '' for trace in data ]
+    return names, np.array([ int(name) if name.isdigit() else -1 for name in names ], dtype=np.int64)
+
+
+def mergemap_indices(merged, data1, data2):
+    """
+    Maps every trace of the merged figure (data2) to the traces of the unmerged figure
+    (data1) it should toggle: the traces of all tracks merged into the cluster, and for
+    traces not belonging to a track, the trace(s) with the same name.
+    Returns a dict with 'offsets' (len(data2)+1) and 'indices': the linked traces of
+    data2[i] are indices[offsets[i]:offsets[i+1]].
+    """
+    names1, trackids1 = _trace_trackids(data1)
+    names2, trackids2 = _trace_trackids(data2)
+    # (cluster trackid, member trackid) pairs
+    clusters = merged.children
+    cluster_ids = np.repeat(
+        np.array([ int(c.trackid) for c in clusters ], dtype=np.int64),
+        [ len(c.merged_tracks) for c in clusters ]
+        )
+    member_ids = np.array([ int(t.trackid) for c in clusters for t in c.merged_tracks ], dtype=np.int64)
+    # cluster -> traces in data1
+    i_pair, i_trace1 = _join_indices(member_ids, trackids1)
+    cluster_trace1 = cluster_ids[i_pair]
+    # traces in data2 -> traces in data1
+    i_trace2, i_link = _join_indices(trackids2, cluster_trace1)
+    keep = trackids2[i_trace2] >= 0
+    trace2 = [i_trace2[keep]]
+    trace1 = [i_trace1[i_link[keep]]]
+    # Non-track traces (front face, compact cluster traces, axes) link by name
+    other1 = { }
+    for i, (name, trackid) in enumerate(zip(names1, trackids1)):
+        if trackid < 0: other1.setdefault(name, []).append(i)
+    for i, (name, trackid) in enumerate(zip(names2, trackids2)):
+        if trackid < 0 and name in other1:
+            trace2.append(np.full(len(other1[name]), i))
+            trace1.append(np.array(other1[name]))
+    trace2 = np.concatenate(trace2).astype(np.int64)
+    trace1 = np.concatenate(trace1).astype(np.int64)
+    order = np.argsort(trace2, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(trace2, minlength=len(data2)))))
+    return dict(offsets=offsets.tolist(), indices=trace1[order].tolist())
+
+
+def js_mergemap(mergemap_indices, js_varname='mergemap'):
+    import json
+    return 'var ' + js_varname + ' = ' + json.dumps(mergemap_indices, separators=(',', ':')) + ';'
+
+
+def write_html(outfile, html, compress=False):
+    """
+    Writes html to outfile (after strftime formatting). With compress=True, the
+    file is gzip-compressed (and '.gz' is appended to outfile if needed); such files
+    should be served with 'Content-Encoding: gzip'.
+    """
     import os, os.path as osp
     from time import strftime
     outfile = strftime(outfile)
+    if compress and not outfile.endswith('.gz'): outfile += '.gz'
     outdir = osp.dirname(osp.abspath(outfile))
     if not osp.isdir(outdir): os.makedirs(outdir)
-    with open(outfile, 'w') as f:
-        f.write(html)
+    if compress:
+        import gzip
+        with gzip.open(outfile, 'wt') as f:
+            f.write(html)
+    else:
+        with open(outfile, 'w') as f:
+            f.write(html)
+    return outfile
+
+
+# ____________________________________________________
+# Batch event site
+
+def merge_event(event, **merge_kwargs):
+    """
+    Default event -> (unmerged, merged) function for build_event_site
+    """
+    unmerged = ht.build_tree(event)
+    merged = ht.trees.merging_algo(unmerged, progress=False, **merge_kwargs)
+    return unmerged, merged
+
+
+def _site_event_worker(args):
+    """
+    Renders one event of the site to its own data file. Runs in a worker process.
+    """
+    import json, os.path as osp
+    from plotly.utils import PlotlyJSONEncoder
+    i, event, outdir, make_trees, merge_kwargs, plot_kwargs = args
+    if ht.is_string(event):
+        # Event store directory + index; open the store in the worker so only
+        # the path needs to be sent to the worker process
+        event = ht.store.EventStore(event)[i]
+    if isinstance(event, tuple):
+        unmerged, merged = event
+    else:
+        unmerged, merged = make_trees(event, **merge_kwargs)
+    data1, data2, info = side_by_side_data(
+        unmerged, merged, compact=plot_kwargs.get('compact', True), lod=plot_kwargs.get('lod', None)
+        )
+    fig1, fig2 = _side_by_side_figures(
+        data1, data2, info, 'Unmerged', 'Merged',
+        plot_kwargs.get('width', 600), plot_kwargs.get('height', None)
+        )
+    encoder = BinaryEncoder(float_dtype=plot_kwargs.get('float_dtype', np.float32))
+    figs = encoder.encode_figures([fig1.to_plotly_json(), fig2.to_plotly_json()])
+    meta = dict(
+        i = i,
+        file = 'events/event_{:05d}.js'.format(i),
+        ntracks = sum(1 for t in unmerged.traverse() if t.nhits),
+        nclusters = len(merged.children),
+        nhits = sum(t.nhits for t in unmerged.traverse()),
+        )
+    payload = dict(buffers=encoder.buffers, figs=figs, mergemap=mergemap_indices(merged, data1, data2))
+    with open(osp.join(outdir, meta['file']), 'w') as f:
+        f.write('htEventLoaded({}, '.format(i))
+        json.dump(payload, f, cls=PlotlyJSONEncoder, separators=(',', ':'))
+        f.write(');\n')
+    return meta
+
+
+def build_event_site(
+    outdir, events, indices=None, nworkers=None, make_trees=merge_event, merge_kwargs=None,
+    compact=True, lod=None, width=600, height=None, title='Event display'
+    ):
+    """
+    Renders many events into one browsable site in `outdir`:
+
+        outdir/index.html            navigation + side-by-side unmerged/merged view
+        outdir/plotly.min.js         one shared local copy of plotly.js
+        outdir/events/event_*.js     binary-encoded figure data per event
+
+    The per-event files are only fetched when the event is viewed. They are loaded by
+    script injection rather than fetch(), so the site also works from file://.
+
+    `events` is an EventStore (or its directory), or a sequence of raw events or
+    (unmerged, merged) tree pairs. Raw events are turned into trees by
+    `make_trees(event, **merge_kwargs)`, which must be picklable. Events are rendered
+    in `nworkers` processes (default: all cpus; nworkers=1 renders in this process).
+    `compact` and `lod` are passed on to plotly_tree.
+    """
+    import os, os.path as osp, json, multiprocessing
+    import plotly.offline
+    if isinstance(events, ht.store.EventStore): events = events.directory
+    if indices is None: indices = range(len(ht.store.EventStore(events)) if ht.is_string(events) else len(events))
+    if merge_kwargs is None: merge_kwargs = {}
+    plot_kwargs = dict(compact=compact, lod=lod, width=width, height=height)
+    if not osp.isdir(osp.join(outdir, 'events')): os.makedirs(osp.join(outdir, 'events'))
+
+    with open(osp.join(outdir, 'plotly.min.js'), 'w') as f:
+        f.write(plotly.offline.get_plotlyjs())
+
+    def iter_args():
+        for i in indices:
+            event = events if ht.is_string(events) else events[i]
+            yield (i, event, outdir, make_trees, merge_kwargs, plot_kwargs)
+
+    if nworkers is None: nworkers = os.cpu_count()
+    if nworkers == 1:
+        metas = [ _site_event_worker(args) for args in ht.tqdm(iter_args(), total=len(indices)) ]
+    else:
+        with multiprocessing.Pool(nworkers) as pool:
+            metas = list(ht.tqdm(
+                pool.imap_unordered(_site_event_worker, iter_args()), total=len(indices)
+                ))
+    metas.sort(key=lambda meta: meta['i'])
+
+    with open(osp.join(outdir, 'index.html'), 'w') as f:
+        f.write(event_site_index_html(metas, title))
+    logger.info('Wrote %s events to %s', len(metas), outdir)
+    return osp.join(outdir, 'index.html')
+
+
+def event_site_index_html(metas, title='Event display'):
+    import json
+    return (
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        f'<title>{title}</title>\n'
+        '<script src="plotly.min.js" charset="utf-8"></script>\n'
+        '</head>\n<body>\n'
+        '<div id="nav">\n'
+        '<button id="prev">&larr;</button>\n'
+        '<select id="eventselect"></select>\n'
+        '<button id="next">&rarr;</button>\n'
+        '<span id="eventinfo"></span>\n'
+        '</div>\n'
+        '<div style="width: 47%; display: inline-block"><div id="ht-left"></div></div>\n'
+        '<div style="width: 47%; display: inline-block"><div id="ht-right"></div></div>\n'
+        '<script>\n'
+        + JS_BINARY_DECODER +
+        '\nvar htEvents = ' + json.dumps(metas) + ';'
+        '\nvar mergemap_site = {offsets: [], indices: []};'
+        '\nvar graphdiv_left = document.getElementById("ht-left");'
+        '\nvar graphdiv_right = document.getElementById("ht-right");'
+        '\nvar htSelect = document.getElementById("eventselect");'
+        '\nvar htCurrent = null;'
+        '\nhtEvents.forEach((ev, j) => htSelect.add(new Option("Event " + ev.i, j)));'
+        # Plotly.react (unlike newPlot) keeps the event handlers attached below
+        '\nPlotly.newPlot(graphdiv_left, [], {});'
+        '\nPlotly.newPlot(graphdiv_right, [], {});'
+        + js_link_cameras('left', 'right') + '\n'
+        + js_link_legends('left', 'right', 'mergemap_site') +
+        """
+function htEventLoaded(i, ev){
+    if (htEvents[htCurrent].i !== i) return
+    const cache = {}
+    const figs = ev.figs.map(fig => htResolve(fig, ev.buffers, cache))
+    mergemap_site = ev.mergemap
+    Plotly.react(graphdiv_left, figs[0].data, figs[0].layout)
+    Plotly.react(graphdiv_right, figs[1].data, figs[1].layout)
+    }
+function htShow(j){
+    if (j < 0 || j >= htEvents.length) return
+    htCurrent = j
+    htSelect.value = j
+    location.hash = htEvents[j].i
+    const meta = htEvents[j]
+    document.getElementById("eventinfo").textContent = (
+        meta.nhits + " hits, " + meta.nclusters + " merged clusters"
+        )
+    const script = document.createElement("script")
+    script.src = meta.file
+    script.onload = () => script.remove()
+    document.head.appendChild(script)
+    }
+htSelect.onchange = () => htShow(parseInt(htSelect.value))
+document.getElementById("prev").onclick = () => htShow(htCurrent - 1)
+document.getElementById("next").onclick = () => htShow(htCurrent + 1)
+document.addEventListener("keydown", e => {
+    if (e.target.tagName === "SELECT") return
+    if (e.key === "ArrowLeft") htShow(htCurrent - 1)
+    if (e.key === "ArrowRight") htShow(htCurrent + 1)
+    })
+const htStart = htEvents.findIndex(ev => String(ev.i) === location.hash.slice(1))
+htShow(htStart < 0 ? 0 : htStart)
+</script>
+</body>
+</html>
+"""
+        )
@@ -0,0 +1,207 @@
+'''
+Association of merged sim clusters to reconstructed objects by shared detids.
+
+The sim side are the tracks with hits of a merged tree (one cluster per track, as
+in trees.columnar_hits), the reco side flat arrays of detid, energy and cluster
+index per reco hit. Per (sim cluster, reco cluster) pair the shared energy is the
+sum over common detids of min(sim energy, reco energy) in that cell:
+
+    assoc = ht.association.associate(merged, reco_detid, reco_energy, reco_cluster)
+    assoc.best_matches()
+'''
+import numpy as np
+import devhgcaltruth as ht
+logger = ht.logger
+
+# Packed keys: event index in the upper bits, detid (unsigned 32 bit) in the lower
+DETID_BITS = 32
+
+
+def join_indices(left, right):
+    '''
+    Sort-merge join: returns index arrays (il, ir) of all pairs with left[il] == right[ir]
+    '''
+    left, right = np.asarray(left), np.asarray(right)
+    order = np.argsort(right, kind='stable')
+    lo = np.searchsorted(right[order], left, 'left')
+    n = np.searchsorted(right[order], left, 'right') - lo
+    il = np.repeat(np.arange(len(left)), n)
+    # Position within each run of equal keys
+    within = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    return il, order[np.repeat(lo, n) + within]
+
+
+def _pack(event, detid):
+    return (np.asarray(event, dtype=np.int64) << DETID_BITS) | (np.asarray(detid, dtype=np.int64) & 0xFFFFFFFF)
+
+
+def cells(cluster, key, energy):
+    '''
+    Sums the energy per (cluster, key) cell. Returns the cluster, key and energy
+    per unique cell.
+    '''
+    cluster, key = np.asarray(cluster, dtype=np.int64), np.asarray(key, dtype=np.int64)
+    order = np.lexsort((key, cluster))
+    cluster, key = cluster[order], key[order]
+    new_cell = np.ones(len(order), dtype=bool)
+    new_cell[1:] = (cluster[1:] != cluster[:-1]) | (key[1:] != key[:-1])
+    begins = np.flatnonzero(new_cell)
+    energy = np.asarray(energy, dtype=np.float64)[order]
+    return cluster[begins], key[begins], np.add.reduceat(energy, begins) if len(order) else energy
+
+
+def sim_hits(merged):
+    '''
+    Columnar sim side of a merged tree: the list of clusters (tracks with hits), and
+    per hit the cluster index, detid and energy
+    '''
+    tracks, hits, index, detids = ht.trees.columnar_hits(merged, include_detid=True)
+    return tracks, index, detids, hits[:,3]
+
+
+class Association(object):
+    '''
+    Sparse (sim cluster x reco cluster) shared energy matrix in COO form: the pair
+    (sim[i], reco[i]) shares `shared[i]` energy. `sim_energy` and `reco_energy` are the
+    total energies per cluster. For a batch, `sim_offsets` and `reco_offsets` give the
+    cluster index ranges of every event.
+    '''
+    def __init__(self, sim, reco, shared, sim_energy, reco_energy, sim_offsets=None, reco_offsets=None):
+        self.sim, self.reco, self.shared = sim, reco, shared
+        self.sim_energy, self.reco_energy = sim_energy, reco_energy
+        self.sim_offsets = np.array([0, len(sim_energy)]) if sim_offsets is None else sim_offsets
+        self.reco_offsets = np.array([0, len(reco_energy)]) if reco_offsets is None else reco_offsets
+
+    @property
+    def shape(self):
+        return len(self.sim_energy), len(self.reco_energy)
+
+    @property
+    def n_events(self):
+        return len(self.sim_offsets) - 1
+
+    def sim_score(self):
+        '''Per pair, the fraction of the sim cluster energy shared with the reco cluster'''
+        return self.shared / np.where(self.sim_energy > 0., self.sim_energy, 1.)[self.sim]
+
+    def reco_score(self):
+        '''Per pair, the fraction of the reco cluster energy shared with the sim cluster'''
+        return self.shared / np.where(self.reco_energy > 0., self.reco_energy, 1.)[self.reco]
+
+    def best_matches(self, from_sim=True):
+        '''
+        Per sim cluster (or reco cluster if from_sim is False), the index of the
+        cluster on the other side it shares most energy with (-1 if none), and the
+        score of that pair
+        '''
+        rows, cols = (self.sim, self.reco) if from_sim else (self.reco, self.sim)
+        score = self.sim_score() if from_sim else self.reco_score()
+        n = self.shape[0] if from_sim else self.shape[1]
+        best = np.full(n, -1, dtype=np.int64)
+        best_score = np.zeros(n)
+        # Last entry per row after sorting by (row, shared energy) is the best one
+        order = np.lexsort((self.shared, rows))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = rows[order][1:] != rows[order][:-1]
+        order = order[last]
+        best[rows[order]] = cols[order]
+        best_score[rows[order]] = score[order]
+        return best, best_score
+
+    def event(self, i):
+        '''The Association of event i of a batch, with cluster indices local to the event'''
+        s0, s1 = self.sim_offsets[i], self.sim_offsets[i+1]
+        r0, r1 = self.reco_offsets[i], self.reco_offsets[i+1]
+        select = (self.sim >= s0) & (self.sim < s1)
+        return Association(
+            self.sim[select] - s0, self.reco[select] - r0, self.shared[select],
+            self.sim_energy[s0:s1], self.reco_energy[r0:r1]
+            )
+
+    def __iter__(self):
+        for i in range(self.n_events):
+            yield self.event(i)
+
+    def to_dense(self):
+        matrix = np.zeros(self.shape)
+        matrix[self.sim, self.reco] = self.shared
+        return matrix
+
+    def to_scipy(self):
+        from scipy.sparse import coo_matrix
+        return coo_matrix((self.shared, (self.sim, self.reco)), shape=self.shape).tocsr()
+
+
+def shared_energy(
+    sim_cluster, sim_detid, sim_energy, reco_cluster, reco_detid, reco_energy,
+    n_sim=None, n_reco=None, sim_event=0, reco_event=0,
+    ):
+    '''
+    Computes the Association from flat per-hit arrays of both sides. Cluster indices
+    are global; for a batch, `sim_event` and `reco_event` give the event per hit so
+    that only detids of the same event are joined.
+    '''
+    sim_cluster, reco_cluster = np.asarray(sim_cluster, dtype=np.int64), np.asarray(reco_cluster, dtype=np.int64)
+    if n_sim is None: n_sim = sim_cluster.max()+1 if len(sim_cluster) else 0
+    if n_reco is None: n_reco = reco_cluster.max()+1 if len(reco_cluster) else 0
+    sim_total = np.bincount(sim_cluster, weights=sim_energy, minlength=n_sim)
+    reco_total = np.bincount(reco_cluster, weights=reco_energy, minlength=n_reco)
+    # Sum per cell first, so every (cluster, detid) appears once on either side
+    sc, skey, se = cells(sim_cluster, _pack(np.broadcast_to(sim_event, sim_cluster.shape), sim_detid), sim_energy)
+    rc, rkey, re = cells(reco_cluster, _pack(np.broadcast_to(reco_event, reco_cluster.shape), reco_detid), reco_energy)
+    i_sim, i_reco = join_indices(skey, rkey)
+    # Sum the per-cell shared energies per (sim, reco) pair
+    pairs = sc[i_sim] * max(n_reco, 1) + rc[i_reco]
+    pairs, inverse = np.unique(pairs, return_inverse=True)
+    shared = np.bincount(inverse.ravel(), weights=np.minimum(se[i_sim], re[i_reco]), minlength=len(pairs))
+    return Association(pairs // max(n_reco, 1), pairs % max(n_reco, 1), shared, sim_total, reco_total)
+
+
+def associate(merged, reco_detid, reco_energy, reco_cluster, n_reco=None):
+    '''
+    Associates the clusters of a merged tree to reco clusters given by flat arrays
+    of detid, energy and cluster index per reco hit. Row i of the result is the
+    i-th track with hits of the tree (in traverse order), available as `.tracks`.
+    '''
+    tracks, sim_cluster, sim_detid, sim_energy = sim_hits(merged)
+    assoc = shared_energy(
+        sim_cluster, sim_detid, sim_energy, reco_cluster, reco_detid, reco_energy,
+        n_sim=len(tracks), n_reco=n_reco
+        )
+    assoc.tracks = tracks
+    return assoc
+
+
+def associate_batch(merged_trees, recos):
+    '''
+    Associates a batch of events in one vectorized join. `recos` is a sequence of
+    (detid, energy, cluster) per event. Returns one Association for the batch;
+    iterate over it (or use `.event(i)`) for the per-event associations.
+    '''
+    merged_trees = list(merged_trees)
+    recos = list(recos)
+    if len(merged_trees) != len(recos):
+        raise ValueError(
+            'Got {} merged trees but {} recos; need one reco per event'
+            .format(len(merged_trees), len(recos))
+            )
+    sim_columns = []
+    sim_offsets = [0]
+    reco_offsets = [0]
+    for i_event, (merged, reco) in enumerate(zip(merged_trees, recos)):
+        tracks, cluster, detid, energy = sim_hits(merged)
+        sim_columns.append((cluster + sim_offsets[-1], detid, energy, np.full(len(cluster), i_event)))
+        sim_offsets.append(sim_offsets[-1] + len(tracks))
+        reco_cluster = np.asarray(reco[2], dtype=np.int64)
+        reco_offsets.append(reco_offsets[-1] + (reco_cluster.max()+1 if len(reco_cluster) else 0))
+    reco_event = np.repeat(np.arange(len(recos)), [ len(reco[0]) for reco in recos ])
+    concat = lambda columns, j: np.concatenate([ c[j] for c in columns ]) if columns else np.zeros(0)
+    assoc = shared_energy(
+        concat(sim_columns, 0).astype(np.int64), concat(sim_columns, 1), concat(sim_columns, 2),
+        concat(recos, 2).astype(np.int64) + np.repeat(reco_offsets[:-1], [ len(reco[2]) for reco in recos ]),
+        concat(recos, 0), concat(recos, 1),
+        n_sim=sim_offsets[-1], n_reco=reco_offsets[-1],
+        sim_event=concat(sim_columns, 3), reco_event=reco_event,
+        )
+    assoc.sim_offsets, assoc.reco_offsets = np.array(sim_offsets), np.array(reco_offsets)
+    return assoc
@@ -0,0 +1,304 @@
+'''
+Merge criteria for the greedy sibling merging in `trees.perform_merging_for_node`.
+
+A criterion scores pairs of sibling clusters with a vectorized function: `prepare`
+stores per-cluster quantities in arrays once per leaf-parent, `update` refreshes the
+row of a cluster after a merge, and `scores` returns (score, aux) arrays for arrays
+of pair indices. Every iteration merges the best pair that passes the threshold (and
+the `max_aux` gate, if set); ties are broken by `tie_break`:
+
+    'first'  : first pair in sibling order (the original behaviour)
+    'energy' : pair with the highest summed deposited (hit) energy of both clusters,
+               then first in sibling order
+
+    merged = ht.trees.merging_algo(root, criterion=ht.criteria.OverlapCriterion(.4))
+
+The dist and overlap criteria are compiled with numba. New criteria can be
+prototyped with `FunctionCriterion`, which takes a vectorized function of per-track
+feature arrays.
+'''
+from math import sqrt
+import numpy as np
+import numba
+import devhgcaltruth as ht
+from .trees import is_inside_numba, SiblingGeometry, F_MOLIERE_RADIUS
+logger = ht.logger
+
+TIE_BREAKS = ('first', 'energy')
+
+
+class MergeCriterion(object):
+    '''
+    Base class: pairs merge if their score is above (higher_is_better) or below the
+    threshold, and their aux value is below max_aux (if not None).
+    `linkage_threshold` is the threshold used when the merging is continued past
+    `threshold` to build a Linkage.
+    '''
+    higher_is_better = True
+    linkage_threshold = -np.inf
+
+    def __init__(self, threshold, tie_break='first', max_aux=None):
+        if tie_break not in TIE_BREAKS:
+            raise ValueError('tie_break should be one of {}, not {}'.format(TIE_BREAKS, tie_break))
+        self.threshold = threshold
+        self.tie_break = tie_break
+        self.max_aux = max_aux
+
+    @property
+    def log_mode(self):
+        '''Key under which pair scores are stored in a MergeLog'''
+        return self.__class__.__name__
+
+    def prepare(self, tracks):
+        raise NotImplementedError
+
+    def update(self, state, i, track):
+        raise NotImplementedError
+
+    def undo(self, state, i, track):
+        '''
+        Called when a merge into track (slot i) is undone. The state is not scored
+        anymore, but anything shared beyond this node (e.g. a cache) must forget track.
+        '''
+        pass
+
+    def scores(self, state, ia, ib):
+        raise NotImplementedError
+
+    def passes(self, score, threshold=None):
+        if threshold is None: threshold = self.threshold
+        return score > threshold if self.higher_is_better else score < threshold
+
+    def gate(self, aux):
+        if self.max_aux is None: return np.ones(np.shape(aux), dtype=bool)
+        return aux < self.max_aux
+
+    def select(self, score, aux, ia, ib, energy, threshold=None):
+        '''
+        Returns the index of the pair to merge among candidate pairs (given in sibling
+        order), or -1 if no pair passes. `energy` is the cluster energy per slot.
+        '''
+        ok = self.gate(aux) & self.passes(score, threshold)
+        if not ok.any(): return -1
+        worst = -np.inf if self.higher_is_better else np.inf
+        masked = np.where(ok, score, worst)
+        best = masked.max() if self.higher_is_better else masked.min()
+        ties = np.flatnonzero(masked == best)
+        if self.tie_break == 'energy' and len(ties) > 1:
+            return ties[np.argmax(energy[ia[ties]] + energy[ib[ties]])]
+        return ties[0]
+
+
+@numba.njit(parallel=True)
+def dist_kernel(centroids, ia, ib):
+    '''Distance between the centroids of pairs (ia[k], ib[k])'''
+    out = np.empty(len(ia))
+    for k in numba.prange(len(ia)):
+        d = 0.
+        for c in range(3):
+            d += (centroids[ib[k],c] - centroids[ia[k],c])**2
+        out[k] = sqrt(d)
+    return out
+
+
+class DistCriterion(MergeCriterion):
+    '''Distance between the hit centroids (trees.dist); lower merges first'''
+    higher_is_better = False
+    linkage_threshold = np.inf
+    log_mode = False
+
+    def __init__(self, threshold=10., tie_break='first'):
+        super().__init__(threshold, tie_break)
+
+    def prepare(self, tracks):
+        return np.array([ t.centroid for t in tracks ], dtype=np.float64).reshape((-1, 3))
+
+    def update(self, state, i, track):
+        state[i] = track.centroid
+
+    def scores(self, state, ia, ib):
+        return dist_kernel(state, ia, ib), np.full(len(ia), np.nan)
+
+
+@numba.njit
+def polygon_overlap_kernel(p1x, p1y, p2x, p2y, nbins):
+    '''Serial version of trees.polygon_overlap_numba, to be called from other kernels'''
+    xmin = min(np.min(p1x), np.min(p2x))
+    xmax = max(np.max(p1x), np.max(p2x))
+    ymin = min(np.min(p1y), np.min(p2y))
+    ymax = max(np.max(p1y), np.max(p2y))
+    x_binning = np.linspace(xmin, xmax, nbins+1)
+    y_binning = np.linspace(ymin, ymax, nbins+1)
+    x_centers = .5*(x_binning[:-1] + x_binning[1:])
+    y_centers = .5*(y_binning[:-1] + y_binning[1:])
+    n_inside_2 = 0
+    n_inside_1_and_2 = 0
+    for ix in range(nbins):
+        for iy in range(nbins):
+            if is_inside_numba(x_centers[ix], y_centers[iy], p2x, p2y):
+                n_inside_2 += 1
+                if is_inside_numba(x_centers[ix], y_centers[iy], p1x, p1y):
+                    n_inside_1_and_2 += 1
+    return float(n_inside_1_and_2) / n_inside_2 if n_inside_2 > 0 else 0.
+
+
+@numba.njit
+def _rotate(Rx, Ry, v):
+    '''v.dot(Rx.T).dot(Ry.T) for a single vector'''
+    w = np.empty(3)
+    for r in range(3):
+        w[r] = Rx[r,0]*v[0] + Rx[r,1]*v[1] + Rx[r,2]*v[2]
+    out = np.empty(3)
+    for r in range(3):
+        out[r] = Ry[r,0]*w[0] + Ry[r,1]*w[1] + Ry[r,2]*w[2]
+    return out
+
+
+@numba.njit(parallel=True)
+def overlap_kernel(b, own_circles, circles, Rx, Ry, v_q10, v_q90, i_f, energy, ia, ib, nbins):
+    '''
+    trees.overlap_geometry for pairs (ia[k], ib[k]) of rows of a SiblingGeometry.
+    Returns the overlap fractions and longitudinal distances.
+    '''
+    n = len(ia)
+    frac = np.empty(n)
+    dz = np.empty(n)
+    n_circle = own_circles.shape[2]
+    for k in numba.prange(n):
+        i1, i2 = ia[k], ib[k]
+        if energy[i2] > energy[i1]: i1, i2 = i2, i1
+        j = i_f[i1,i2]
+        o = b[i1]
+        p1x = own_circles[i1,j,:,0].copy()
+        p1y = own_circles[i1,j,:,1].copy()
+        p2x = np.empty(n_circle)
+        p2y = np.empty(n_circle)
+        for p in range(n_circle):
+            r = _rotate(Rx[i1], Ry[i1], circles[i2,j,p] - o)
+            p2x[p], p2y[p] = r[0], r[1]
+        frac[k] = polygon_overlap_kernel(p1x, p1y, p2x, p2y, nbins)
+        zb1 = _rotate(Rx[i1], Ry[i1], v_q10[i1] - o)[2]
+        ze1 = _rotate(Rx[i1], Ry[i1], v_q90[i1] - o)[2]
+        zb2 = _rotate(Rx[i1], Ry[i1], v_q10[i2] - o)[2]
+        ze2 = _rotate(Rx[i1], Ry[i1], v_q90[i2] - o)[2]
+        if zb2 < zb1: zb1, ze1, zb2, ze2 = zb2, ze2, zb1, ze1
+        dz[k] = zb2 - ze1
+    return frac, dz
+
+
+class OverlapCriterion(MergeCriterion):
+    '''
+    Overlap of the moliere-radius circles (trees.overlap); higher merges first, and
+    pairs only merge if their longitudinal distance is below max_dz.
+    `f_moliere_radius` are the energy fractions for 1 hadron + 1 em, 2 hadrons and 2 em.
+    '''
+    higher_is_better = True
+    linkage_threshold = 0.
+    log_mode = True
+
+    def __init__(
+        self, threshold=.5, max_dz=10., tie_break='first',
+        f_moliere_radius=F_MOLIERE_RADIUS, n_circle=30, nbins=30
+        ):
+        super().__init__(threshold, tie_break, max_aux=max_dz)
+        self.f_moliere_radius = f_moliere_radius
+        self.n_circle = n_circle
+        self.nbins = nbins
+
+    def prepare(self, tracks):
+        geometry = SiblingGeometry(tracks, self.f_moliere_radius, self.n_circle)
+        geometry.energy = np.array([ t.energyAtBoundary for t in geometry.tracks ], dtype=np.float64)
+        return geometry
+
+    def update(self, state, i, track):
+        state.compute(i, track)
+        state.energy[i] = track.energyAtBoundary
+
+    def scores(self, state, ia, ib):
+        g = state
+        return overlap_kernel(
+            g.b, g.own_circles, g.circles, g.Rx, g.Ry, g.v_q10, g.v_q90,
+            g.i_f_moliere_radius, g.energy,
+            np.asarray(ia, dtype=np.int64), np.asarray(ib, dtype=np.int64), self.nbins
+            )
+
+
+class FunctionCriterion(MergeCriterion):
+    '''
+    Criterion from a vectorized function: `features(track)` returns a 1D array per
+    track, and `score_fn(fa, fb)` takes the (n_pairs, n_features) feature arrays of
+    both clusters of every pair and returns the scores, or a (scores, aux) tuple.
+    '''
+    def __init__(
+        self, score_fn, features, threshold, higher_is_better=True,
+        tie_break='first', max_aux=None, linkage_threshold=None
+        ):
+        super().__init__(threshold, tie_break, max_aux)
+        self.score_fn = score_fn
+        self.features = features
+        self.higher_is_better = higher_is_better
+        if linkage_threshold is None: linkage_threshold = -np.inf if higher_is_better else np.inf
+        self.linkage_threshold = linkage_threshold
+
+    def prepare(self, tracks):
+        return np.array([ np.atleast_1d(self.features(t)) for t in tracks ], dtype=np.float64).reshape((len(tracks), -1))
+
+    def update(self, state, i, track):
+        state[i] = self.features(track)
+
+    def scores(self, state, ia, ib):
+        out = self.score_fn(state[ia], state[ib])
+        if isinstance(out, tuple): return out
+        return np.asarray(out, dtype=np.float64), np.full(len(ia), np.nan)
+
+
+class PairFnCriterion(MergeCriterion):
+    '''
+    Criterion from a per-pair Python function fn(t1, t2) -> (score, aux), e.g. a
+    custom `overlap_fn`. Slow; meant for diagnostics and legacy functions.
+    '''
+    def __init__(
+        self, fn, threshold, higher_is_better=True, tie_break='first', max_aux=None,
+        linkage_threshold=None, log_mode=None
+        ):
+        super().__init__(threshold, tie_break, max_aux)
+        self.fn = fn
+        self.higher_is_better = higher_is_better
+        if linkage_threshold is None: linkage_threshold = -np.inf if higher_is_better else np.inf
+        self.linkage_threshold = linkage_threshold
+        if log_mode is not None: self._log_mode = log_mode
+
+    @property
+    def log_mode(self):
+        return getattr(self, '_log_mode', self.__class__.__name__)
+
+    def prepare(self, tracks):
+        return list(tracks)
+
+    def update(self, state, i, track):
+        state[i] = track
+        self.evict(track)
+
+    def undo(self, state, i, track):
+        self.evict(track)
+
+    def evict(self, track):
+        '''Drops the cached scores of a changed track if fn caches (e.g. trees.CachedDistFn)'''
+        if hasattr(self.fn, 'remove2'):
+            self.fn.remove2(track, track)
+        elif hasattr(self.fn, 'remove'):
+            self.fn.remove(track)
+
+    def scores(self, state, ia, ib):
+        out = [ self.fn(state[a], state[b]) for a, b in zip(ia, ib) ]
+        score = np.array([ o[0] for o in out ], dtype=np.float64)
+        aux = np.array([ o[1] for o in out ], dtype=np.float64)
+        return score, aux
+
+
+def from_legacy_kwargs(use_overlap_algo=False, default_min_r=10., min_overlap=.5, max_dz=10., overlap_fn=None):
+    '''Criterion equivalent to the keyword arguments of perform_merging_for_node'''
+    if not use_overlap_algo: return DistCriterion(default_min_r)
+    if overlap_fn is not None:
+        return PairFnCriterion(overlap_fn, min_overlap, max_aux=max_dz, linkage_threshold=0., log_mode=True)
+    return OverlapCriterion(min_overlap, max_dz)
@@ -0,0 +1,108 @@
+'''
+Vectorized eta/phi/deltaR kinematics.
+
+Positions are (N, 3) arrays of x, y, z (a single (3,) position works too).
+Conventions: phi = arctan2(y, x) in [-pi, pi), eta = arcsinh(z / rho) (signed, so
+the negative endcap has negative eta).
+'''
+import numpy as np
+import devhgcaltruth as ht
+logger = ht.logger
+
+TWO_PI = 2.*np.pi
+
+
+def r_eta_phi(xyz):
+    '''
+    Returns the radial distance R, eta and phi of the positions xyz
+    '''
+    xyz = np.asarray(xyz, dtype=np.float64)
+    x, y, z = xyz[...,0], xyz[...,1], xyz[...,2]
+    rho = np.hypot(x, y)
+    with np.errstate(divide='ignore'):
+        # rho == 0: eta = +-inf along the beam line
+        eta = np.arcsinh(z / rho)
+    return np.sqrt(rho**2 + z**2), eta, np.arctan2(y, x)
+
+
+def eta_phi(xyz):
+    R, eta, phi = r_eta_phi(xyz)
+    return eta, phi
+
+
+def wrap_phi(dphi):
+    '''Wraps phi differences to [-pi, pi) in one modular step'''
+    return np.mod(np.asarray(dphi) + np.pi, TWO_PI) - np.pi
+
+
+def deltar(eta1, phi1, eta2, phi2):
+    '''deltaR between (broadcastable) arrays of eta and phi'''
+    dphi = wrap_phi(np.subtract(phi1, phi2))
+    return np.sqrt(dphi**2 + np.subtract(eta1, eta2)**2)
+
+
+def deltar_matrix(eta1, phi1, eta2, phi2):
+    '''(n1, n2) matrix of deltaR between all pairs of two sets of n1 and n2 directions'''
+    return deltar(
+        np.asarray(eta1)[:,None], np.asarray(phi1)[:,None],
+        np.asarray(eta2)[None,:], np.asarray(phi2)[None,:],
+        )
+
+
+def deltar_xyz(xyz1, xyz2):
+    '''deltaR matrix between two sets of positions'''
+    eta1, phi1 = eta_phi(xyz1)
+    eta2, phi2 = eta_phi(xyz2)
+    return deltar_matrix(eta1, phi1, eta2, phi2)
+
+
+def match(eta1, phi1, eta2, phi2, max_dr=None):
+    '''
+    Matches every direction in set 1 to the closest direction in set 2.
+    Returns the index in set 2 and the deltaR per element of set 1; the index
+    is -1 if set 2 is empty or the closest deltaR exceeds max_dr.
+    '''
+    dr = deltar_matrix(eta1, phi1, eta2, phi2)
+    if dr.shape[1] == 0:
+        return np.full(dr.shape[0], -1, dtype=np.int64), np.full(dr.shape[0], np.inf)
+    best = np.argmin(dr, axis=1)
+    best_dr = dr[np.arange(dr.shape[0]), best]
+    if max_dr is not None: best[best_dr > max_dr] = -1
+    return best, best_dr
+
+
+def cluster_positions(hits, index, n=None):
+    '''
+    Energy-weighted centroids of clusters of hits.
+    `hits` is an (N, 4) array of x, y, z, energy, `index` the cluster index per hit
+    (as returned by trees.columnar_hits). Returns the (n, 3) centroids and (n,) energies.
+    '''
+    hits = np.asarray(hits)
+    if n is None: n = index.max()+1 if len(index) else 0
+    energy = np.bincount(index, weights=hits[:,3], minlength=n)
+    xyz = np.stack([
+        np.bincount(index, weights=hits[:,3]*hits[:,i], minlength=n) for i in range(3)
+        ], axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xyz /= energy[:,None]
+    return xyz, energy
+
+
+def track_positions(tracks, at_boundary=True):
+    '''(N, 3) array of the (boundary) positions of tracks'''
+    keys = ('xAtBoundary', 'yAtBoundary', 'zAtBoundary') if at_boundary else ('x', 'y', 'z')
+    return np.array(
+        [ [getattr(t, k) for k in keys] for t in tracks ], dtype=np.float64
+        ).reshape((-1, 3))
+
+
+def match_clusters(hits, index, xyz, max_dr=None):
+    '''
+    Angular matching of clusters of hits (see `cluster_positions`) to positions xyz,
+    e.g. the boundary positions of generator particles.
+    Returns the index in xyz and the deltaR per cluster.
+    '''
+    centroids, _ = cluster_positions(hits, index)
+    eta1, phi1 = eta_phi(centroids)
+    eta2, phi2 = eta_phi(xyz)
+    return match(eta1, phi1, eta2, phi2, max_dr)
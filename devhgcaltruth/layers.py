@@ -0,0 +1,88 @@
+'''
+Layer-indexed binning of hits.
+
+Every hit is assigned to its HGCAL layer (index in ht.Z_POS_LAYERS / ht.Z_NEG_LAYERS)
+with one searchsorted over the whole event, and the energy per (cluster, layer) is
+stored as a compact (n_clusters, N_LAYERS) array:
+
+    tracks, hits, index = ht.trees.columnar_hits(root)
+    profiles = ht.layers.LayerProfiles(hits, index)
+    profiles.containment_layer(.9)
+'''
+import numpy as np
+import devhgcaltruth as ht
+logger = ht.logger
+
+N_LAYERS = len(ht.Z_POS_LAYERS)
+LAYER_Z = np.array(ht.Z_POS_LAYERS)
+
+
+def hit_layers(z):
+    '''Layer index per hit, for both endcaps (same as ht.layer_index, but as int8)'''
+    return ht.layer_index(z).astype(np.int8)
+
+
+class LayerProfiles(object):
+    '''
+    Per-layer energy profiles of clusters of hits.
+    `hits` is an (N, 4) array of x, y, z, energy and `index` the cluster index per hit
+    (as returned by trees.columnar_hits). Row i of `profiles` is the energy of
+    cluster i per layer; `layer` is the layer index per hit, which other per-hit
+    computations (e.g. plotting LOD) can reuse.
+    '''
+    def __init__(self, hits, index, n_clusters=None, dtype=np.float32):
+        hits = np.asarray(hits).reshape((-1, 4))
+        index = np.asarray(index, dtype=np.int64)
+        if n_clusters is None: n_clusters = index.max()+1 if len(index) else 0
+        self.n_clusters = n_clusters
+        self.layer = hit_layers(hits[:,2])
+        self.profiles = np.bincount(
+            index * N_LAYERS + self.layer, weights=hits[:,3], minlength=n_clusters*N_LAYERS
+            ).reshape((n_clusters, N_LAYERS)).astype(dtype)
+
+    @classmethod
+    def from_tree(cls, node, **kwargs):
+        '''Profiles of all tracks with hits in the tree below (and including) node'''
+        tracks, hits, index = ht.trees.columnar_hits(node)
+        profiles = cls(hits, index, len(tracks), **kwargs)
+        profiles.tracks = tracks
+        return profiles
+
+    @property
+    def energy(self):
+        return self.profiles.sum(axis=1, dtype=np.float64)
+
+    def fractions(self, cumulative=True):
+        '''
+        (Cumulative) energy fraction per layer, in float64; rows without energy are
+        all 0. The total is the last cumulative column, so the cumulative fraction
+        in the last layer is exactly 1.
+        '''
+        cumulative_profiles = np.cumsum(self.profiles, axis=1, dtype=np.float64)
+        profiles = cumulative_profiles if cumulative else self.profiles.astype(np.float64)
+        energy = cumulative_profiles[:,-1]
+        return profiles / np.where(energy > 0., energy, 1.)[:,None]
+
+    def containment_layer(self, quantile):
+        '''
+        First layer at which the cumulative energy fraction of each cluster reaches
+        `quantile`; -1 for clusters without energy, or if the quantile is never
+        reached (quantile > 1)
+        '''
+        reached = self.fractions() >= quantile
+        layer = np.where(reached.any(axis=1), np.argmax(reached, axis=1), -1)
+        layer[self.energy <= 0.] = -1
+        return layer
+
+    def shower_start(self, threshold=.05):
+        '''
+        First layer in which a cluster deposits more than `threshold` of its energy;
+        -1 for clusters without energy
+        '''
+        above = self.fractions(cumulative=False) > threshold
+        return np.where(above.any(axis=1), np.argmax(above, axis=1), -1)
+
+    def layer_z(self, layer, sign=1):
+        '''z positions of layer indices (positive endcap for sign=1); nan for -1'''
+        layer = np.asarray(layer)
+        return np.where(layer >= 0, sign * LAYER_Z[np.maximum(layer, 0)], np.nan)
@@ -0,0 +1,188 @@
+'''
+Clustering-quality metrics of merged trees, computed for many events at once.
+
+A partition assigns every original track with hits to a cluster. It is read from
+the hits of a merged tree: merged clusters own the hits of all their merged_tracks,
+and every hit keeps its original track as parent. Partitions of a batch are flat
+arrays of event, trackid, cluster label and deposited energy, and all metrics are
+computed from one sparse contingency table of (event, reference label, cluster):
+
+    truth = ht.metrics.batch_partitions(unmerged_trees, ht.metrics.primary_partition)
+    pred = ht.metrics.batch_partitions(merged_trees)
+    ht.metrics.evaluate(truth, pred)
+'''
+import numpy as np
+import devhgcaltruth as ht
+logger = ht.logger
+
+
+def partition(merged):
+    '''
+    Cluster label per original track with hits of a merged tree (the index of its
+    cluster among the tracks with hits, in traverse order). Returns the arrays
+    trackid, label and deposited energy, sorted by trackid.
+    '''
+    clusters = [ t for t in ht.trees.traverse(merged) if t.nhits > 0 ]
+    trackid = np.array([ h.parent.trackid for c in clusters for h in c.hits ], dtype=np.int64)
+    energy = np.array([ h.energy for c in clusters for h in c.hits ], dtype=np.float64)
+    label = np.repeat(np.arange(len(clusters)), [ c.nhits for c in clusters ])
+    trackid, inverse = np.unique(trackid, return_inverse=True)
+    inverse = inverse.ravel()
+    # A track is in exactly one cluster, so any of its hits gives the label
+    track_label = np.zeros(len(trackid), dtype=np.int64)
+    track_label[inverse] = label
+    return trackid, track_label, np.bincount(inverse, weights=energy, minlength=len(trackid))
+
+
+def primary_partition(root):
+    '''Reference partition of an (unmerged) tree: tracks labeled by their primary'''
+    rows = [
+        (track.trackid, i_primary, sum(h.energy for h in track.hits))
+        for i_primary, primary in enumerate(root.children)
+        for track in primary.traverse() if track.nhits > 0
+        ]
+    trackid = np.array([ r[0] for r in rows ], dtype=np.int64)
+    order = np.argsort(trackid)
+    label = np.array([ r[1] for r in rows ], dtype=np.int64)
+    energy = np.array([ r[2] for r in rows ], dtype=np.float64)
+    return trackid[order], label[order], energy[order]
+
+
+def batch_partitions(trees, partition_fn=partition):
+    '''
+    Concatenates the partitions of a batch of trees into a dict of flat arrays
+    event, trackid, label and energy
+    '''
+    parts = [ partition_fn(tree) for tree in trees ]
+    concat = lambda j, dtype: np.concatenate([ p[j] for p in parts ]).astype(dtype) if parts else np.zeros(0, dtype)
+    return {
+        'event' : np.repeat(np.arange(len(parts)), [ len(p[0]) for p in parts ]),
+        'trackid' : concat(0, np.int64),
+        'label' : concat(1, np.int64),
+        'energy' : concat(2, np.float64),
+        'n_events' : len(parts),
+        }
+
+
+def _runs(*columns):
+    '''
+    Sorts rows by the given columns (first column most significant). Returns the
+    order and the start positions of runs of equal rows in sorted order.
+    '''
+    order = np.lexsort(columns[::-1])
+    new_run = np.zeros(len(order), dtype=bool)
+    new_run[:1] = True
+    for c in columns:
+        c = c[order]
+        new_run[1:] |= c[1:] != c[:-1]
+    return order, np.flatnonzero(new_run)
+
+
+def _group_sum(values, order, starts):
+    return np.add.reduceat(values[order], starts) if len(order) else values[:0]
+
+
+def _group_max(values, order, starts):
+    return np.maximum.reduceat(values[order], starts) if len(order) else values[:0]
+
+
+def align(truth, pred):
+    '''
+    Joins two batch partitions on (event, trackid). Returns event, truth label,
+    predicted label and energy (from pred) per track present in both.
+    '''
+    key = lambda p: (p['event'].astype(np.int64) << 32) | (p['trackid'] & 0xFFFFFFFF)
+    i_truth, i_pred = ht.association.join_indices(key(truth), key(pred))
+    n_missing = len(pred['trackid']) - len(i_pred)
+    if n_missing: logger.warning('%s predicted tracks not in the reference partition', n_missing)
+    return truth['event'][i_truth], truth['label'][i_truth], pred['label'][i_pred], pred['energy'][i_pred]
+
+
+def contingency(event, a, b, weights=None):
+    '''
+    Sparse contingency table of two labelings per event. Returns per non-empty
+    (event, a, b) cell: event, a, b, summed weight and element count.
+    '''
+    order, starts = _runs(event, a, b)
+    weights = np.ones(len(event)) if weights is None else np.asarray(weights, dtype=np.float64)
+    counts = np.diff(np.append(starts, len(order)))
+    return event[order[starts]], a[order[starts]], b[order[starts]], _group_sum(weights, order, starts), counts
+
+
+def purity_efficiency(event, a, b, weights, n_events=None):
+    '''
+    Per event energy-weighted purity and efficiency of clustering b w.r.t. the
+    reference a: purity is the fraction of energy of each b cluster in its dominant
+    a label, efficiency the fraction of each a label in its dominant b cluster,
+    both summed over clusters and divided by the event energy
+    '''
+    if n_events is None: n_events = event.max()+1 if len(event) else 0
+    ce, ca, cb, cw, _ = contingency(event, a, b, weights)
+    total = np.bincount(ce, weights=cw, minlength=n_events)
+    order, starts = _runs(ce, cb)
+    purity = np.bincount(ce[order[starts]], weights=_group_max(cw, order, starts), minlength=n_events)
+    order, starts = _runs(ce, ca)
+    efficiency = np.bincount(ce[order[starts]], weights=_group_max(cw, order, starts), minlength=n_events)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return purity / total, efficiency / total
+
+
+def _comb2(n):
+    n = np.asarray(n, dtype=np.float64)
+    return n * (n - 1.) / 2.
+
+
+def adjusted_rand_index(event, a, b, n_events=None):
+    '''Per event adjusted Rand index of labelings a and b (over elements, unweighted)'''
+    if n_events is None: n_events = event.max()+1 if len(event) else 0
+    ce, ca, cb, _, counts = contingency(event, a, b)
+    index = np.bincount(ce, weights=_comb2(counts), minlength=n_events)
+    sum_a = np.zeros(n_events)
+    sum_b = np.zeros(n_events)
+    for labels, sums in [(ca, sum_a), (cb, sum_b)]:
+        order, starts = _runs(ce, labels)
+        np.add.at(sums, ce[order[starts]], _comb2(_group_sum(counts, order, starts)))
+    n = np.bincount(event, minlength=n_events)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = sum_a * sum_b / _comb2(n)
+        maximum = .5 * (sum_a + sum_b)
+        ari = (index - expected) / (maximum - expected)
+    # Identical trivial partitions (e.g. all singletons, or fewer than 2 tracks, for
+    # which expected is 0/0) count as perfect agreement
+    ari[(maximum == expected) | (n < 2)] = 1.
+    return ari
+
+
+def multiplicity(partitions):
+    '''
+    Number of clusters per event of a batch partition, and the distribution of
+    that number (counts per multiplicity)
+    '''
+    event, label = partitions['event'], partitions['label']
+    order, starts = _runs(event, label)
+    n_clusters = np.bincount(event[order[starts]], minlength=partitions.get('n_events', 0))
+    return n_clusters, np.bincount(n_clusters)
+
+
+def evaluate(truth, pred):
+    '''
+    All metrics of a batch partition `pred` against the reference `truth`. Returns a
+    dict of per-event arrays and batch means.
+    '''
+    n_events = max(truth.get('n_events', 0), pred.get('n_events', 0))
+    event, a, b, energy = align(truth, pred)
+    purity, efficiency = purity_efficiency(event, a, b, energy, n_events)
+    ari = adjusted_rand_index(event, a, b, n_events)
+    n_clusters, distribution = multiplicity(pred)
+    n_reference, _ = multiplicity(truth)
+    return {
+        'purity' : purity,
+        'efficiency' : efficiency,
+        'ari' : ari,
+        'n_clusters' : n_clusters,
+        'n_reference' : n_reference,
+        'multiplicity' : distribution,
+        'mean_purity' : np.nanmean(purity) if len(purity) else np.nan,
+        'mean_efficiency' : np.nanmean(efficiency) if len(efficiency) else np.nan,
+        'mean_ari' : np.nanmean(ari) if len(ari) else np.nan,
+        }
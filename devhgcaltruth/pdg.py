@@ -0,0 +1,130 @@
+'''
+Vectorized PDG id classification and coloring.
+
+All functions take a scalar, a numpy array, or a jagged (per-event) awkward array
+of pdgids, and return the same structure. Work is done on the unique |pdgid| values
+only (there are few distinct pdgids per event) and mapped back with a take.
+'''
+import numpy as np
+import devhgcaltruth as ht
+logger = ht.logger
+
+# Classes returned by `classify`
+CLASS_OTHER = 0
+CLASS_EM = 1 # electrons and photons
+CLASS_MESON = 2
+CLASS_BARYON = 3
+CLASS_NAMES = ['other', 'em', 'meson', 'baryon']
+
+EM_PDGIDS = np.array([11, 22])
+
+
+def _map_flat(fn, pdgid):
+    '''
+    Applies fn (flat np array -> flat np array) to a scalar, np array or jagged array
+    '''
+    if hasattr(pdgid, 'content') and hasattr(pdgid, 'counts'):
+        # awkward0 JaggedArray (as read by uptools)
+        return pdgid.copy(content=fn(np.asarray(pdgid.content)))
+    if type(pdgid).__module__.split('.')[0] == 'awkward':
+        import awkward as ak
+        return ak.unflatten(fn(ak.to_numpy(ak.flatten(pdgid))), ak.num(pdgid))
+    if np.ndim(pdgid) == 0:
+        return fn(np.array([pdgid]))[0]
+    pdgid = np.asarray(pdgid)
+    return fn(pdgid.ravel()).reshape(pdgid.shape)
+
+
+def _map_unique(fn, pdgid):
+    '''
+    Like _map_flat, but fn is only evaluated on the unique |pdgid| values
+    '''
+    def unique_fn(flat):
+        unique, inverse = np.unique(np.abs(flat), return_inverse=True)
+        return fn(unique)[inverse.ravel()]
+    return _map_flat(unique_fn, pdgid)
+
+
+def digits(pdgid, n=None, base=10):
+    '''
+    Returns the digits of |pdgid| (least significant first) as an array of shape
+    (n,) + shape of pdgid. If n is None, as many digits as the largest |pdgid| has.
+    '''
+    pdgid = np.abs(np.asarray(pdgid, dtype=np.int64))
+    if n is None:
+        largest = pdgid.max() if pdgid.size else 0
+        n = 0
+        while largest > 0:
+            largest //= base
+            n += 1
+    powers = base ** np.arange(n, dtype=np.int64).reshape((-1,) + (1,)*pdgid.ndim)
+    return (pdgid[None] // powers) % base
+
+
+def _is_hadron(apdgid):
+    return apdgid >= 111
+
+def _is_meson(apdgid):
+    d = digits(apdgid, 4)
+    return (d[3] == 0) & (d[2] > 0)
+
+def _classify(apdgid):
+    hadron = _is_hadron(apdgid)
+    meson = _is_meson(apdgid)
+    cls = np.full(apdgid.shape, CLASS_OTHER, dtype=np.int8)
+    cls[np.isin(apdgid, EM_PDGIDS)] = CLASS_EM
+    cls[hadron & meson] = CLASS_MESON
+    cls[hadron & ~meson] = CLASS_BARYON
+    return cls
+
+
+def is_hadron(pdgid):
+    '''|pdgid| >= 111; the definition used to pick the moliere radius fraction'''
+    return _map_flat(lambda p: _is_hadron(np.abs(p)), pdgid)
+
+def is_meson(pdgid):
+    return _map_unique(_is_meson, pdgid)
+
+def is_baryon(pdgid):
+    return _map_unique(lambda p: _is_hadron(p) & ~_is_meson(p), pdgid)
+
+def is_em(pdgid):
+    return _map_flat(lambda p: np.isin(np.abs(p), EM_PDGIDS), pdgid)
+
+def classify(pdgid):
+    '''Returns the CLASS_* code per pdgid'''
+    return _map_unique(_classify, pdgid)
+
+
+def color_table(colors=None, default_value='xkcd:gray'):
+    '''
+    Returns the sorted |pdgid| keys and the colors of a pdgid -> color dict
+    (ht.PDGID_COLORS by default), with the default color appended
+    '''
+    if colors is None: colors = ht.PDGID_COLORS
+    keys = np.array(sorted(colors), dtype=np.int64)
+    values = np.array([colors[k] for k in keys] + [default_value])
+    return keys, values
+
+def color_pdgid(pdgid, default_value='xkcd:gray', colors=None):
+    '''Colors per pdgid, looked up in ht.PDGID_COLORS (or `colors`)'''
+    keys, values = color_table(colors, default_value)
+    def lookup(apdgid):
+        i = np.minimum(np.searchsorted(keys, apdgid), len(keys)-1)
+        return values[np.where(keys[i] == apdgid, i, len(keys))]
+    color = _map_unique(lookup, pdgid)
+    return str(color) if isinstance(color, np.str_) else color
+
+
+def f_moliere_radius_index(is_hadron1, is_hadron2):
+    '''
+    Vectorized trees.i_f_moliere_radius: index in trees.F_MOLIERE_RADIUS for pairs with
+    the given hadron flags (0: 1 hadron + 1 em, 1: 2 hadrons, 2: 2 em)
+    '''
+    is_hadron1, is_hadron2 = np.asarray(is_hadron1), np.asarray(is_hadron2)
+    return np.where(is_hadron1 != is_hadron2, 0, np.where(is_hadron1, 1, 2)).astype(np.int8)
+
+def f_moliere_radius_matrix(pdgids):
+    '''(n, n) matrix of f_moliere_radius_index for all pairs of n pdgids'''
+    hadron = is_hadron(np.asarray(pdgids))
+    return f_moliere_radius_index(hadron[:,None], hadron[None,:])
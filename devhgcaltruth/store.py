@@ -0,0 +1,284 @@
+'''
+Flat, memory-mapped store of the simtrack_* and simhit_* branches.
+
+Every branch is written as one flat binary file (all events concatenated), next to
+per-event offsets for the tracks and the hits. Loading an event is then just a
+zero-copy slice of the memory-mapped columns:
+
+    ht.store.convert_rootfiles('ntuple.root', 'mystore')
+    store = ht.store.EventStore('mystore')
+    tree = ht.build_tree(store[12])
+
+With `split_endcaps=True`, the tracks and hits of every event are stored ordered by
+endcap (positive z first), so the two endcaps of an event are zero-copy views too:
+
+    pos, neg = store[12].split_endcaps(flip=True)
+'''
+import numpy as np, os, os.path as osp, json
+import devhgcaltruth as ht
+logger = ht.logger
+
+TRACK_PREFIX = 'simtrack_'
+HIT_PREFIX = 'simhit_'
+META_FILE = 'meta.json'
+# Columns that are negated by a view with zsign = -1
+Z_COLUMNS = {
+    TRACK_PREFIX + 'z', TRACK_PREFIX + 'boundary_z', TRACK_PREFIX + 'vertex_z', HIT_PREFIX + 'z'
+    }
+
+
+def _decode(key):
+    return key.decode() if isinstance(key, bytes) else key
+
+
+def primary_index(trackid, parenttrackid):
+    '''
+    Per track, the index of its primary ancestor: the first ancestor whose parent is
+    not in the event (i.e. a child of the root in `ht.build_tree`).
+    Uses pointer doubling, so it takes log(depth) vectorized steps.
+    '''
+    trackid, parenttrackid = np.asarray(trackid), np.asarray(parenttrackid)
+    n = len(trackid)
+    if n == 0: return np.zeros(0, dtype=np.int64)
+    order = np.argsort(trackid, kind='stable')
+    i = np.minimum(np.searchsorted(trackid[order], parenttrackid), n-1)
+    parent = np.where(trackid[order[i]] == parenttrackid, order[i], np.arange(n))
+    for _ in range(int(np.log2(n)) + 2):
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent): break
+        parent = grandparent
+    return parent
+
+
+def endcap_order(tracks, hits):
+    '''
+    Orders the tracks and hits of one event by endcap, positive z first, keeping the
+    original order within an endcap. A track belongs to the endcap of its primary
+    ancestor (as in `ht.split_endcaps`), a hit to the endcap of its track.
+    `tracks` and `hits` are dicts of columns without prefix (see `EventView.tracks()`).
+    Returns the track order, the hit order, and the number of positive tracks and hits.
+    '''
+    trackid = np.asarray(tracks['trackid'])
+    neg_track = np.asarray(tracks['z'])[primary_index(trackid, tracks['parenttrackid'])] < 0.
+    hit_trackid = np.asarray(hits['trackid'])
+    neg_hit = np.asarray(hits['z']) < 0.
+    if len(trackid):
+        order = np.argsort(trackid, kind='stable')
+        i = np.minimum(np.searchsorted(trackid[order], hit_trackid), len(trackid)-1)
+        # Hits of unknown tracks go by their own z
+        neg_hit = np.where(trackid[order[i]] == hit_trackid, neg_track[order[i]], neg_hit)
+    return (
+        np.argsort(neg_track, kind='stable'), np.argsort(neg_hit, kind='stable'),
+        int((~neg_track).sum()), int((~neg_hit).sum())
+        )
+
+
+def _strip(columns, prefix):
+    return { name[len(prefix):] : column for name, column in columns.items() if name.startswith(prefix) }
+
+
+def _order_by_endcap(columns):
+    '''Reorders a dict of prefixed columns of one event by endcap (see `endcap_order`)'''
+    track_order, hit_order, n_pos_tracks, n_pos_hits = endcap_order(
+        _strip(columns, TRACK_PREFIX), _strip(columns, HIT_PREFIX)
+        )
+    columns = {
+        name : column[track_order if name.startswith(TRACK_PREFIX) else hit_order]
+        for name, column in columns.items()
+        }
+    return columns, n_pos_tracks, n_pos_hits
+
+
+def convert(events, outdir, nmax=None, split_endcaps=False):
+    '''
+    One-time conversion of events to a store in `outdir`.
+    `events` is an iterable of per-event mappings of branch name -> array, i.e. the
+    same objects that are passed to `ht.build_tree`.
+    If `split_endcaps` is True, tracks and hits are ordered by endcap within every
+    event, so `EventView.split_endcaps` does not need to copy.
+    '''
+    if not osp.isdir(outdir): os.makedirs(outdir)
+    files = {}
+    dtypes = {}
+    track_offsets = [0]
+    hit_offsets = [0]
+    track_splits = []
+    hit_splits = []
+    try:
+        for i_event, event in enumerate(ht.tqdm(events, desc='converting', total=nmax)):
+            if nmax is not None and i_event == nmax: break
+            columns = {}
+            for key in event.keys():
+                name = _decode(key)
+                if not(name.startswith(TRACK_PREFIX) or name.startswith(HIT_PREFIX)): continue
+                columns[name] = np.asarray(event[key])
+            if split_endcaps:
+                columns, n_pos_tracks, n_pos_hits = _order_by_endcap(columns)
+                track_splits.append(track_offsets[-1] + n_pos_tracks)
+                hit_splits.append(hit_offsets[-1] + n_pos_hits)
+            n_tracks = n_hits = None
+            for name, column in columns.items():
+                if name not in files:
+                    if i_event > 0:
+                        raise ValueError('Column {} first appeared in event {}'.format(name, i_event))
+                    files[name] = open(osp.join(outdir, name + '.bin'), 'wb')
+                    dtypes[name] = column.dtype
+                column.astype(dtypes[name], copy=False).tofile(files[name])
+                if name.startswith(TRACK_PREFIX):
+                    n_tracks = len(column)
+                else:
+                    n_hits = len(column)
+            track_offsets.append(track_offsets[-1] + (n_tracks or 0))
+            hit_offsets.append(hit_offsets[-1] + (n_hits or 0))
+    finally:
+        for f in files.values(): f.close()
+    np.save(osp.join(outdir, TRACK_PREFIX + 'offsets.npy'), np.array(track_offsets, dtype=np.int64))
+    np.save(osp.join(outdir, HIT_PREFIX + 'offsets.npy'), np.array(hit_offsets, dtype=np.int64))
+    if split_endcaps:
+        np.save(osp.join(outdir, TRACK_PREFIX + 'splits.npy'), np.array(track_splits, dtype=np.int64))
+        np.save(osp.join(outdir, HIT_PREFIX + 'splits.npy'), np.array(hit_splits, dtype=np.int64))
+    meta = {
+        'n_events' : len(track_offsets) - 1,
+        'n_tracks' : track_offsets[-1],
+        'n_hits' : hit_offsets[-1],
+        'split_endcaps' : bool(split_endcaps),
+        'columns' : { name : dtype.str for name, dtype in dtypes.items() },
+        }
+    with open(osp.join(outdir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info(
+        'Converted %s events (%s tracks, %s hits) to %s',
+        meta['n_events'], meta['n_tracks'], meta['n_hits'], outdir
+        )
+    return outdir
+
+
+def convert_rootfiles(rootfiles, outdir, nmax=None, split_endcaps=False, **kwargs):
+    '''
+    Converts rootfiles (read via uptools) to a store in `outdir`
+    '''
+    import uptools
+    return convert(uptools.iter_events(rootfiles, **kwargs), outdir, nmax=nmax, split_endcaps=split_endcaps)
+
+
+class EventStore(object):
+    '''
+    Read-only, memory-mapped access to a store created by `convert`
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(osp.join(directory, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.track_offsets = np.load(osp.join(directory, TRACK_PREFIX + 'offsets.npy'), mmap_mode='r')
+        self.hit_offsets = np.load(osp.join(directory, HIT_PREFIX + 'offsets.npy'), mmap_mode='r')
+        if self.meta.get('split_endcaps', False):
+            self.track_splits = np.load(osp.join(directory, TRACK_PREFIX + 'splits.npy'), mmap_mode='r')
+            self.hit_splits = np.load(osp.join(directory, HIT_PREFIX + 'splits.npy'), mmap_mode='r')
+        else:
+            self.track_splits = self.hit_splits = None
+        self.columns = {}
+        for name, dtype in self.meta['columns'].items():
+            n = self.meta['n_tracks'] if name.startswith(TRACK_PREFIX) else self.meta['n_hits']
+            if n == 0:
+                # np.memmap can't map empty files
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(
+                    osp.join(directory, name + '.bin'), dtype=dtype, mode='r', shape=(n,)
+                    )
+
+    def __len__(self):
+        return self.meta['n_events']
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError('Event {} out of range'.format(i))
+        return EventView(
+            self.columns,
+            int(self.track_offsets[i]), int(self.track_offsets[i+1]),
+            int(self.hit_offsets[i]), int(self.hit_offsets[i+1]),
+            track_split=None if self.track_splits is None else int(self.track_splits[i]),
+            hit_split=None if self.hit_splits is None else int(self.hit_splits[i]),
+            )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class EventView(object):
+    '''
+    One event of an EventStore. Columns are zero-copy slices of the memory-mapped arrays.
+    Behaves like the event mappings from uptools (keys are bytes), so it can be passed
+    to `ht.build_tree` directly.
+    `track_split` and `hit_split` are the (absolute) positions of the first track and
+    hit of the negative endcap, if the columns are ordered by endcap. A view with
+    zsign = -1 returns the z columns negated.
+    '''
+    def __init__(
+        self, columns, track_begin, track_end, hit_begin, hit_end,
+        track_split=None, hit_split=None, zsign=1
+        ):
+        self._columns = columns
+        self.track_slice = slice(track_begin, track_end)
+        self.hit_slice = slice(hit_begin, hit_end)
+        self.track_split = track_split
+        self.hit_split = hit_split
+        self.zsign = zsign
+
+    @property
+    def ntracks(self):
+        return self.track_slice.stop - self.track_slice.start
+
+    @property
+    def nhits(self):
+        return self.hit_slice.stop - self.hit_slice.start
+
+    def keys(self):
+        return [ name.encode() for name in self._columns ]
+
+    def __contains__(self, key):
+        return _decode(key) in self._columns
+
+    def __getitem__(self, key):
+        name = _decode(key)
+        column = self._columns[name]
+        column = column[self.track_slice if name.startswith(TRACK_PREFIX) else self.hit_slice]
+        if self.zsign < 0 and name in Z_COLUMNS: column = -column
+        return column
+
+    def split_endcaps(self, flip=False):
+        '''
+        Returns views of the positive and negative endcap of this event. If `flip`
+        is True, the z columns of the negative endcap view are negated on access.
+        Zero-copy if the store was converted with split_endcaps=True; otherwise the
+        event is reordered in memory first.
+        '''
+        if self.track_split is None:
+            columns, n_pos_tracks, n_pos_hits = _order_by_endcap({ name : self[name] for name in self._columns })
+            return EventView(
+                columns, 0, self.ntracks, 0, self.nhits, n_pos_tracks, n_pos_hits
+                ).split_endcaps(flip)
+        pos = EventView(
+            self._columns, self.track_slice.start, self.track_split,
+            self.hit_slice.start, self.hit_split, zsign=self.zsign
+            )
+        neg = EventView(
+            self._columns, self.track_split, self.track_slice.stop,
+            self.hit_split, self.hit_slice.stop, zsign=-self.zsign if flip else self.zsign
+            )
+        return pos, neg
+
+    def tracks(self):
+        '''Returns a dict of the simtrack_ columns (without prefix)'''
+        return {
+            name[len(TRACK_PREFIX):] : self[name]
+            for name in self._columns if name.startswith(TRACK_PREFIX)
+            }
+
+    def hits(self):
+        '''Returns a dict of the simhit_ columns (without prefix)'''
+        return {
+            name[len(HIT_PREFIX):] : self[name]
+            for name in self._columns if name.startswith(HIT_PREFIX)
+            }
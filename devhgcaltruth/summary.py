@@ -0,0 +1,103 @@
+'''
+Per-cluster energy bookkeeping of merged trees, computed in one pass over the
+columnar data:
+
+    table = ht.summary.cluster_summary(merged)
+    table['deposited_energy'] / table['boundary_energy']
+
+Tables are dicts of equal-length column arrays, one row per cluster (track with
+hits, in traverse order); batch tables have an extra `event` column.
+'''
+import numpy as np
+import devhgcaltruth as ht
+logger = ht.logger
+
+COLUMNS = [
+    'trackid', 'boundary_energy', 'deposited_energy', 'n_merged', 'nhits',
+    'centroid_x', 'centroid_y', 'centroid_z',
+    'boundary_x', 'boundary_y', 'boundary_z',
+    ]
+INT_COLUMNS = {'event', 'trackid', 'n_merged', 'nhits'}
+
+
+def cluster_summary(merged):
+    '''
+    Per cluster: the summed boundary energy and energy-weighted boundary position of
+    its merged tracks (as Track.average_boundary_pos), the deposited energy, the
+    number of merged tracks, the hit count and the energy-weighted hit centroid
+    '''
+    tracks, hits, index = ht.trees.columnar_hits(merged)
+    n = len(tracks)
+    n_merged = np.array([ len(t.merged_tracks) for t in tracks ], dtype=np.int64)
+    merged_tracks = [ m for t in tracks for m in t.merged_tracks ]
+    boundary = np.array(
+        [ (m.energyAtBoundary, m.xAtBoundary, m.yAtBoundary, m.zAtBoundary) for m in merged_tracks ],
+        dtype=np.float64
+        ).reshape((-1, 4))
+    merged_index = np.repeat(np.arange(n), n_merged)
+    boundary_energy = np.bincount(merged_index, weights=boundary[:,0], minlength=n)
+    centroids, deposited = ht.kinematics.cluster_positions(hits, index, n)
+    table = {
+        'trackid' : np.array([ t.trackid for t in tracks ], dtype=np.int64),
+        'boundary_energy' : boundary_energy,
+        'deposited_energy' : deposited,
+        'n_merged' : n_merged,
+        'nhits' : np.bincount(index, minlength=n),
+        }
+    for i, c in enumerate('xyz'):
+        table['centroid_' + c] = centroids[:,i]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table['boundary_' + c] = np.bincount(
+                merged_index, weights=boundary[:,0]*boundary[:,i+1], minlength=n
+                ) / boundary_energy
+    return table
+
+
+def batch_summary(merged_trees):
+    '''Concatenated cluster_summary tables of several events, with an `event` column'''
+    tables = [ cluster_summary(merged) for merged in merged_trees ]
+    if not tables:
+        return { key : np.zeros(0, dtype=np.int64 if key in INT_COLUMNS else np.float64) for key in ['event'] + COLUMNS }
+    batch = { key : np.concatenate([ t[key] for t in tables ]) for key in COLUMNS }
+    batch['event'] = np.repeat(np.arange(len(tables)), [ len(t['trackid']) for t in tables ])
+    return batch
+
+
+def event_totals(batch, n_events=None):
+    '''
+    Per event totals of a batch table: boundary and deposited energy, their ratio,
+    and the number of clusters and hits. Pass `n_events` to include trailing events
+    without clusters.
+    '''
+    event = batch['event']
+    n = n_events if n_events is not None else (event.max()+1 if len(event) else 0)
+    totals = {
+        key : np.bincount(event, weights=batch[key], minlength=n)
+        for key in ['boundary_energy', 'deposited_energy']
+        }
+    totals['nclusters'] = np.bincount(event, minlength=n)
+    totals['nhits'] = np.bincount(event, weights=batch['nhits'], minlength=n).astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        totals['ratio'] = totals['deposited_energy'] / totals['boundary_energy']
+    return totals
+
+
+def aggregate(batch, quantiles=(.1, .5, .9), n_events=None):
+    '''
+    Batch-level validation metrics: totals, and quantiles of the per-cluster and
+    per-event ratio of deposited to boundary energy
+    '''
+    totals = event_totals(batch, n_events)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = batch['deposited_energy'] / batch['boundary_energy']
+    finite = lambda a: a[np.isfinite(a)]
+    quantile = lambda a: np.quantile(a, quantiles) if len(a) else np.full(len(quantiles), np.nan)
+    return {
+        'n_events' : len(totals['nclusters']),
+        'n_clusters' : len(batch['event']),
+        'n_hits' : int(batch['nhits'].sum()),
+        'boundary_energy' : float(batch['boundary_energy'].sum()),
+        'deposited_energy' : float(batch['deposited_energy'].sum()),
+        'cluster_ratio_quantiles' : quantile(finite(ratio)),
+        'event_ratio_quantiles' : quantile(finite(totals['ratio'])),
+        }
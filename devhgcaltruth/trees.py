@@ -46,37 +46,22 @@ def print_tree(root):
 
 def retaphi(x, y, z):
     '''
-    Transforms cartesian coordinates into eta-phi and the radial distance
+    Transforms cartesian coordinates into eta-phi and the radial distance.
+    See ht.kinematics.r_eta_phi for the vectorized version.
     '''
-    norm = np.linalg.norm
-    p = np.array([x, y, z])
-    pz = np.array([0, 0, z])
-    theta = np.arccos(p.dot(pz) / (norm(p)*norm(pz)))
-    eta = -np.log(np.tan(theta/2.))
-    phi = np.arctan2(x, y)
-    R = norm(p)
-    return R, eta, phi
+    return ht.kinematics.r_eta_phi(np.array([x, y, z]))
 
 def deltar(eta1, phi1, eta2, phi2):
-    dphi = phi1 - phi2
-    # Some normalization of phi - first substract whole 2*pi's,
-    # then flip to -pi < phi < pi regime
-    if isinstance(dphi, float):
-        if dphi > 2.*pi: dphi -= 2.*pi
-        if dphi < -2.*pi: dphi += 2.*pi
-        if dphi > pi: dphi -= 2.*pi
-        if dphi < -pi: dphi += 2.*pi
-    else:
-        dphi[dphi > 2.*pi] -= 2.*pi
-        dphi[dphi < -2.*pi] += 2.*pi
-        dphi[dphi > pi] -= 2.*pi
-        dphi[dphi < -pi] += 2.*pi
-    dr = np.sqrt( dphi**2 + (eta1-eta2)**2 )
-    return dr
+    return ht.kinematics.deltar(eta1, phi1, eta2, phi2)
 
 def deltar_tracks(t1, t2):
-    p1, p2 = t1.momentum, t2.momentum
-    return deltar(p1.eta, p1.phi, p2.eta, p2.phi)
+    p1, p2 = getattr(t1, 'momentum', None), getattr(t2, 'momentum', None)
+    if hasattr(p1, 'eta') and hasattr(p2, 'eta'):
+        return deltar(p1.eta, p1.phi, p2.eta, p2.phi)
+    # No momentum objects (e.g. trees built from columns): use the boundary positions
+    return ht.kinematics.deltar_xyz(
+        ht.kinematics.track_positions([t1]), ht.kinematics.track_positions([t2])
+        )[0,0]
 
 def hitcentroid(track):
     if track.nhits == 0: return None
@@ -118,17 +103,56 @@ def flipz_tree(root):
         node.hits = copy.deepcopy(node.hits)
         for hit in node.hits:
             hit.z *= -1.
+        node.invalidate()
     return root
 
 
-def needs_hit_displacement_quantities(method):
-    def wrapper(*args, **kwargs):
-        self = args[0]
-        if not hasattr(self, '_'+method.__name__):
-            logger.debug('Updating self.update_hit_displacement_quantities()')
-            self.update_hit_displacement_quantities()
-        return method(*args, **kwargs)
-    return wrapper
+# Lazily computed Track quantities, per group: (quantities, groups they depend on).
+# A group is computed at once on first access of any of its quantities.
+QUANTITY_GROUPS = {
+    'pdgid' : (('is_hadron',), ()),
+    'hits' : (('centroid', 'secondmoment'), ()),
+    'boundary' : (('b',), ()),
+    'axis' : (('e', 'axis'), ('hits', 'boundary')),
+    'displacement' : ((
+        'ds_to_axis', 'sorted_d_to_axis', 'energy_fractions_to_axis',
+        'sorted_d_along_axis', 'energy_fractions_along_axis',
+        'long_q10', 'v_q10', 'long_q90', 'v_q90',
+        ), ('axis',)),
+    }
+
+
+def _invalidated_quantities(group):
+    '''Quantities of group and of all groups that (indirectly) depend on it'''
+    names = set()
+    todo = [group]
+    while todo:
+        g = todo.pop()
+        names.update(QUANTITY_GROUPS[g][0])
+        todo.extend(d for d, (_, depends) in QUANTITY_GROUPS.items() if g in depends)
+    return tuple(sorted(names))
+
+INVALIDATED_QUANTITIES = { g : _invalidated_quantities(g) for g in QUANTITY_GROUPS }
+INVALIDATED_QUANTITIES[None] = tuple(sorted(n for names, _ in QUANTITY_GROUPS.values() for n in names))
+
+
+class cached_quantity(object):
+    '''
+    Lazily computed Track property of a group in QUANTITY_GROUPS. The value is
+    stored in the instance __dict__, so after the first access it is a plain
+    attribute lookup; Track.invalidate removes it again.
+    '''
+    def __init__(self, group, doc=None):
+        self.group = group
+        self.__doc__ = doc
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, track, owner=None):
+        if track is None: return self
+        track.compute_quantities(self.group)
+        return track.__dict__[self.name]
 
 
 class Track(object):
@@ -226,56 +250,73 @@ class Track(object):
                 )
             )
 
+    centroid = cached_quantity('hits')
+    secondmoment = cached_quantity('hits')
+    b = cached_quantity('boundary')
+    e = cached_quantity('axis')
+    axis = cached_quantity('axis')
+    is_hadron = cached_quantity('pdgid')
+    ds_to_axis = cached_quantity(
+        'displacement',
+        'Returns the perpendicular displacement of each hit w.r.t. the shower axis\n'
+        '(Somewhat expensive to recompute)'
+        )
+    sorted_d_to_axis = cached_quantity('displacement')
+    energy_fractions_to_axis = cached_quantity('displacement')
+    sorted_d_along_axis = cached_quantity('displacement')
+    energy_fractions_along_axis = cached_quantity('displacement')
+    long_q10 = cached_quantity('displacement')
+    v_q10 = cached_quantity('displacement')
+    long_q90 = cached_quantity('displacement')
+    v_q90 = cached_quantity('displacement')
+
+    def compute_quantities(self, group):
+        self.__dict__.update(getattr(self, '_compute_' + group)())
+
+    def invalidate(self, group=None):
+        '''
+        Drops the cached quantities of group (one of QUANTITY_GROUPS; all if None) and
+        of the groups depending on it. Call after modifying the hits ('hits'), the
+        boundary position ('boundary') or the pdgid ('pdgid').
+        '''
+        for name in INVALIDATED_QUANTITIES[group]: self.__dict__.pop(name, None)
+
     def update_hit_dependent_quantities(self, displacement_quantities=True):
-        self._centroid, self._secondmoment = hitcentroid(self)
-        # Shower axis info (cheap to recompute)
-        self._b = np.array([self.xAtBoundary, self.yAtBoundary, self.zAtBoundary])
-        self._e = self.centroid
-        self._axis = (self.e-self.b) / np.linalg.norm(self.e-self.b)
-        if displacement_quantities:
-            self.update_hit_displacement_quantities()
+        '''Recomputes the hit dependent quantities now, rather than on first access'''
+        self.invalidate('hits')
+        self.invalidate('boundary')
+        self.compute_quantities('axis')
+        if displacement_quantities: self.compute_quantities('displacement')
 
-    @property
-    def centroid(self):
-        if not hasattr(self, '_centroid'): self.update_hit_dependent_quantities()
-        return self._centroid
+    def update_hit_displacement_quantities(self):
+        self.invalidate('displacement')
+        self.compute_quantities('displacement')
 
-    @property
-    def secondmoment(self):
-        if not hasattr(self, '_secondmoment'): self.update_hit_dependent_quantities()
-        return self._secondmoment
+    def _compute_pdgid(self):
+        return dict(is_hadron=ht.is_hadron(self.pdgid))
 
-    @property
-    def b(self):
-        if not hasattr(self, '_b'): self.update_hit_dependent_quantities()
-        return self._b
+    def _compute_hits(self):
+        centroid, secondmoment = hitcentroid(self)
+        return dict(centroid=centroid, secondmoment=secondmoment)
 
-    @property
-    def e(self):
-        if not hasattr(self, '_e'): self.update_hit_dependent_quantities()
-        return self._e
+    def _compute_boundary(self):
+        return dict(b=np.array([self.xAtBoundary, self.yAtBoundary, self.zAtBoundary]))
 
-    @property
-    def axis(self):
-        if not hasattr(self, '_axis'): self.update_hit_dependent_quantities()
-        return self._axis
-
-    @property
-    def is_hadron(self):
-        if not hasattr(self, '_is_hadron'): self._is_hadron = ht.is_hadron(self.pdgid)
-        return self._is_hadron
+    def _compute_axis(self):
+        # Shower axis info (cheap to recompute)
+        e = self.centroid
+        return dict(e=e, axis=(e-self.b) / np.linalg.norm(e-self.b))
 
-    def update_hit_displacement_quantities(self):
+    def _compute_displacement(self):
         # Compute the displacements
-        # v_to_axis = []
+        b, axis = self.b, self.axis
         d_to_axis = []
         d_along_axis = []
         energies = []
         for i, hit in enumerate(self.hits):
-            hitpos = np.array([hit.x, hit.y, hit.z]) - self.b  # Shift to the begin_point
-            proj_along_axis = hitpos.dot(self.axis)*self.axis
+            hitpos = np.array([hit.x, hit.y, hit.z]) - b  # Shift to the begin_point
+            proj_along_axis = hitpos.dot(axis)*axis
             v = hitpos - proj_along_axis  # Subtract the projection on the axis (yielding the perpendicular component)
-            # v_to_axis.append(v)
             d_to_axis.append(np.linalg.norm(v))
             d_along_axis.append(np.linalg.norm(proj_along_axis))
             energies.append(hit.energy)
@@ -285,71 +326,21 @@ class Track(object):
         total_energy = np.sum(energies)
         d_to_axis = np.array(d_to_axis)
         d_along_axis = np.array(d_along_axis)
-        # v_to_axis = np.array(v_to_axis)
-
-        self._ds_to_axis = d_to_axis
 
+        q = dict(ds_to_axis=d_to_axis)
         order = np.argsort(d_to_axis)
-        self._sorted_d_to_axis = d_to_axis[order]
-        self._energy_fractions_to_axis = np.cumsum(energies[order]) / total_energy
-
+        q['sorted_d_to_axis'] = d_to_axis[order]
+        q['energy_fractions_to_axis'] = np.cumsum(energies[order]) / total_energy
         order = np.argsort(d_along_axis)
-        self._sorted_d_along_axis = d_along_axis[order]
-        self._energy_fractions_along_axis = np.cumsum(energies[order]) / total_energy
-
-        self._long_q10 = self.longitudinal_energy_containment(.1)
-        self._v_q10 = self.b +  self._long_q10 * self.axis
-        self._long_q90 = self.longitudinal_energy_containment(.9)
-        self._v_q90 = self.b +  self._long_q90 * self.axis
-
-    @property
-    @needs_hit_displacement_quantities
-    def ds_to_axis(self):
-        '''
-        Returns the perpendicular displacement of each hit w.r.t. the shower axis
-        (Somewhat expensive to recompute)
-        '''
-        return self._ds_to_axis
-
-    @property
-    @needs_hit_displacement_quantities
-    def energy_fractions_along_axis(self):
-        return self._energy_fractions_along_axis
-
-    @property
-    @needs_hit_displacement_quantities
-    def energy_fractions_to_axis(self):
-        return self._energy_fractions_to_axis
+        q['sorted_d_along_axis'] = d_along_axis[order]
+        q['energy_fractions_along_axis'] = np.cumsum(energies[order]) / total_energy
 
-    @property
-    @needs_hit_displacement_quantities
-    def sorted_d_to_axis(self):
-        return self._sorted_d_to_axis
-
-    @property
-    @needs_hit_displacement_quantities
-    def sorted_d_along_axis(self):
-        return self._sorted_d_along_axis
-    
-    @property    
-    @needs_hit_displacement_quantities
-    def long_q10(self):
-        return self._long_q10
-
-    @property    
-    @needs_hit_displacement_quantities
-    def v_q10(self):
-        return self._v_q10
-
-    @property    
-    @needs_hit_displacement_quantities
-    def long_q90(self):
-        return self._long_q90
-
-    @property    
-    @needs_hit_displacement_quantities
-    def v_q90(self):
-        return self._v_q90
+        # Same as longitudinal_energy_containment, which would recurse here
+        for quantile, key in [(.1, 'q10'), (.9, 'q90')]:
+            long_q = q['sorted_d_along_axis'][np.argmax(q['energy_fractions_along_axis'] > quantile)]
+            q['long_' + key] = long_q
+            q['v_' + key] = b + long_q * axis
+        return q
 
     def moliere_radius(self, r):
         return self.sorted_d_to_axis[np.argmax(self.energy_fractions_to_axis > r)]
@@ -385,9 +376,66 @@ class Track(object):
         return np.concatenate(hits)
 
 
+def columnar_hits(node, include_detid=False):
+    '''
+    Concatenates the hits of all tracks with hits in the tree below (and including) node.
+    Returns the list of tracks with hits (in traverse order), an (N, 4) array of
+    x, y, z, energy, and per hit the index of its track in the list.
+    If `include_detid` is True, also returns the (N,) array of detids.
+    The hits of tracks[i] are hits[offsets[i]:offsets[i+1]], with
+    offsets = np.cumsum([0] + [t.nhits for t in tracks]).
+    '''
+    tracks = [ t for t in traverse(node) if t.nhits > 0 ]
+    hits = np.array(
+        [ (h.x, h.y, h.z, h.energy) for t in tracks for h in t.hits ], dtype=np.float64
+        ).reshape((-1, 4))
+    index = np.repeat(np.arange(len(tracks)), [t.nhits for t in tracks])
+    if include_detid:
+        detids = np.array([ h.detid for t in tracks for h in t.hits ], dtype=np.int64)
+        return tracks, hits, index, detids
+    return tracks, hits, index
+
+
+def aggregate_hits(hits):
+    '''
+    Merges simhits that share a detid within a track: energies are summed and
+    positions energy-weighted (plain mean for cells without energy).
+    `hits` is a dict of the simhit_ columns without prefix (at least trackid, detid,
+    x, y, z and energy). Returns a dict of the aggregated columns (sorted by trackid,
+    then detid) with an extra `nsimhits` column, and per original simhit the index
+    of its aggregated hit. The simhits of aggregated hit i are
+    order[offsets[i]:offsets[i+1]], with `order` and `offsets` also returned.
+    '''
+    trackid = np.asarray(hits['trackid'])
+    detid = np.asarray(hits['detid'])
+    order = np.lexsort((detid, trackid))
+    trackid, detid = trackid[order], detid[order]
+    new_cell = np.ones(len(order), dtype=bool)
+    new_cell[1:] = (trackid[1:] != trackid[:-1]) | (detid[1:] != detid[:-1])
+    offsets = np.append(np.flatnonzero(new_cell), len(order))
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(new_cell) - 1
+    begins = offsets[:-1]
+    nsimhits = np.diff(offsets)
+    energy = np.asarray(hits['energy'])[order]
+    cell_energy = np.add.reduceat(energy, begins) if len(order) else energy
+    # Fall back to equal weights in cells without energy
+    weights = np.where(np.repeat(cell_energy > 0., nsimhits), energy, 1.)
+    total_weights = np.add.reduceat(weights, begins) if len(order) else weights
+    aggregated = dict(
+        trackid=trackid[begins], detid=detid[begins], energy=cell_energy, nsimhits=nsimhits
+        )
+    for key in ['x', 'y', 'z']:
+        v = np.asarray(hits[key])[order] * weights
+        aggregated[key] = (np.add.reduceat(v, begins) if len(order) else v) / total_weights
+    return aggregated, inverse, order, offsets
+
+
 class Hit(object):
-    def __init__(self, detid, x, y, z, energy, parent):
+    def __init__(self, detid, x, y, z, energy, parent, simhits=None):
         self.detid, self.x, self.y, self.z, self.energy, self.parent = detid, x, y, z, energy, parent
+        # Indices of the original simhits (in the event) of a detid-aggregated hit
+        if simhits is not None: self.simhits = simhits
     
     def __repr__(self):
         return super().__repr__().replace(
@@ -483,52 +531,204 @@ def trim_tree(root, inplace=False):
                 child.parent = node.parent
     return root
 
-def make_graph(node):
-    import networkx as nx
-    G = nx.Graph()
+def graph_arrays(node, collapse_depth=None, max_nodes=None):
+    '''
+    Array-based export of the (sub)tree below node. Returns a dict of columns, one row
+    per graph node in traverse order:
+        trackid, pdgid, energy, crossedBoundary, depth,
+        parent: row index of the parent (-1 for node itself),
+        nhits: number of hits (including the hits of collapsed descendants),
+        n_collapsed: number of descendants collapsed into this node,
+    and 'edges', an (m, 2) array of (parent row, child row).
+    Subtrees below `collapse_depth` (relative to node) are collapsed into their ancestor
+    at that depth. With `max_nodes`, the collapse depth is chosen as the largest depth
+    for which at most max_nodes nodes remain (at least the node itself is kept).
+    '''
+    tracks = []
+    depths = []
+    parent = []
+    last_at_depth = []
+    for track, depth in traverse(node, yield_depth=True):
+        del last_at_depth[depth:]
+        parent.append(last_at_depth[-1] if depth > 0 else -1)
+        last_at_depth.append(len(tracks))
+        tracks.append(track)
+        depths.append(depth)
+    depths = np.array(depths, dtype=np.int64)
+    parent = np.array(parent, dtype=np.int64)
+    nhits = np.array([ t.nhits for t in tracks ], dtype=np.int64)
+
+    if max_nodes is not None:
+        n_up_to_depth = np.cumsum(np.bincount(depths))
+        allowed = np.flatnonzero(n_up_to_depth <= max_nodes)
+        depth_for_budget = allowed[-1] if len(allowed) else 0
+        collapse_depth = depth_for_budget if collapse_depth is None else min(collapse_depth, depth_for_budget)
+
+    keep = np.ones(len(tracks), dtype=bool)
+    n_collapsed = np.zeros(len(tracks), dtype=np.int64)
+    if collapse_depth is not None and len(tracks) and depths.max() > collapse_depth:
+        # Find for every row its ancestor at collapse_depth, by walking up the parent
+        # array for all deep rows at once
+        ancestor = np.arange(len(tracks))
+        for _ in range(depths.max() - collapse_depth):
+            deep = depths[ancestor] > collapse_depth
+            ancestor[deep] = parent[ancestor[deep]]
+        keep = depths <= collapse_depth
+        collapsed = ~keep
+        nhits = nhits + np.bincount(ancestor[collapsed], weights=nhits[collapsed], minlength=len(tracks)).astype(np.int64)
+        n_collapsed = np.bincount(ancestor[collapsed], minlength=len(tracks))
+
+    # Renumber the kept rows
+    new_index = np.cumsum(keep) - 1
+    parent = parent[keep]
+    parent = np.where(parent >= 0, new_index[np.maximum(parent, 0)], -1)
+    tracks = [ t for t, k in zip(tracks, keep) if k ]
+    has_parent = np.flatnonzero(parent >= 0)
+    return dict(
+        trackid = np.array([ int(t.trackid) for t in tracks ], dtype=np.int64),
+        pdgid = np.array([ int(t.pdgid) for t in tracks ], dtype=np.int64),
+        energy = np.array([ t.energy for t in tracks ], dtype=np.float64),
+        crossedBoundary = np.array([ bool(t.crossedBoundary) for t in tracks ], dtype=bool),
+        depth = depths[keep],
+        parent = parent,
+        nhits = nhits[keep],
+        n_collapsed = n_collapsed[keep],
+        edges = np.stack((parent[has_parent], has_parent), axis=-1).reshape((-1, 2)),
+        )
 
-    nodes_ids = []
-    nodes_infos = []
-    edges = []
-    labels = {}
-    
-    for track in traverse(node):
-        nodes_ids.append(track.trackid)
-        nodes_infos.append(
-            {'pdgid': track.pdgid, 'energy' : track.energy}
+
+def graph_labels(arrays):
+    '''
+    Labels per row of graph_arrays, e.g. '12 E=3.1 nhits=40 X (+5)'
+    '''
+    labels = []
+    for trackid, energy, nhits, crossed, n_collapsed in zip(
+        arrays['trackid'], arrays['energy'], arrays['nhits'],
+        arrays['crossedBoundary'], arrays['n_collapsed']
+        ):
+        label = '{} E={:.1f}'.format(trackid, energy)
+        if nhits > 0: label += ' nhits={}'.format(nhits)
+        if crossed: label += ' X'
+        if n_collapsed > 0: label += ' (+{})'.format(n_collapsed)
+        labels.append(label)
+    return labels
+
+
+def _hex_colors_pdgid(pdgids):
+    from matplotlib.colors import to_hex
+    names = ht.color_pdgid(pdgids)
+    unique, inverse = np.unique(names, return_inverse=True)
+    return np.array([ to_hex(c) for c in unique ])[inverse.ravel()]
+
+
+def write_dot(node_or_arrays, outfile, labels=True, **kwargs):
+    '''
+    Writes the tree (or the output of graph_arrays) to a graphviz DOT file, colored by
+    pdgid. kwargs are passed to graph_arrays (e.g. collapse_depth, max_nodes).
+    Returns outfile (strftime formatted).
+    '''
+    arrays = node_or_arrays if isinstance(node_or_arrays, dict) else graph_arrays(node_or_arrays, **kwargs)
+    colors = _hex_colors_pdgid(arrays['pdgid'])
+    texts = graph_labels(arrays) if labels else [ str(i) for i in arrays['trackid'] ]
+    lines = ['digraph tree {', '  node [style=filled];']
+    lines.extend(
+        '  {} [label="{}", fillcolor="{}"];'.format(trackid, text, color)
+        for trackid, text, color in zip(arrays['trackid'], texts, colors)
+        )
+    trackid = arrays['trackid']
+    lines.extend(
+        '  {} -> {};'.format(a, b)
+        for a, b in zip(trackid[arrays['edges'][:,0]], trackid[arrays['edges'][:,1]])
+        )
+    lines.append('}')
+    outfile = _prepare_outfile(outfile)
+    with open(outfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return outfile
+
+
+GRAPHML_ATTRIBUTES = [
+    # column, graphml type
+    ('pdgid', 'long'),
+    ('energy', 'double'),
+    ('nhits', 'long'),
+    ('crossedBoundary', 'boolean'),
+    ('depth', 'int'),
+    ('n_collapsed', 'long'),
+    ]
+
+def write_graphml(node_or_arrays, outfile, **kwargs):
+    '''
+    Writes the tree (or the output of graph_arrays) to a GraphML file, with the
+    graph_arrays columns as node attributes. kwargs are passed to graph_arrays.
+    Returns outfile (strftime formatted).
+    '''
+    arrays = node_or_arrays if isinstance(node_or_arrays, dict) else graph_arrays(node_or_arrays, **kwargs)
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">',
+        ]
+    lines.extend(
+        '  <key id="{0}" for="node" attr.name="{0}" attr.type="{1}"/>'.format(name, type)
+        for name, type in GRAPHML_ATTRIBUTES
+        )
+    lines.append('  <graph id="tree" edgedefault="directed">')
+    columns = [ arrays[name] for name, _ in GRAPHML_ATTRIBUTES ]
+    for i, trackid in enumerate(arrays['trackid']):
+        data = ''.join(
+            '<data key="{}">{}</data>'.format(
+                name, str(bool(column[i])).lower() if type == 'boolean' else column[i]
+                )
+            for (name, type), column in zip(GRAPHML_ATTRIBUTES, columns)
             )
-        for child in track.children:
-            edges.append([track.trackid, child.trackid])
-            
-        label = '{} E={:.1f}'.format(track.trackid, track.energy)
-        if track.nhits > 0: label += ' nhits={}'.format(track.nhits)
-        if track.crossedBoundary: label += ' X'
-        labels[track.trackid] = label
+        lines.append('    <node id="n{}">{}</node>'.format(trackid, data))
+    trackid = arrays['trackid']
+    lines.extend(
+        '    <edge source="n{}" target="n{}"/>'.format(a, b)
+        for a, b in zip(trackid[arrays['edges'][:,0]], trackid[arrays['edges'][:,1]])
+        )
+    lines.extend(['  </graph>', '</graphml>'])
+    outfile = _prepare_outfile(outfile)
+    with open(outfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return outfile
+
 
+def make_graph(node, collapse_depth=None, max_nodes=None):
+    '''
+    Returns the tree as a networkx.Graph (see graph_arrays for the collapse options),
+    with the labels in G.mylabels
+    '''
+    import networkx as nx
+    arrays = graph_arrays(node, collapse_depth=collapse_depth, max_nodes=max_nodes)
+    trackid = arrays['trackid'].tolist()
+    G = nx.Graph()
     G.add_nodes_from(
-        np.stack((
-            np.array(nodes_ids),
-            np.array(nodes_infos, dtype=object)
-            )).T
+        (i, {'pdgid' : pdgid, 'energy' : energy})
+        for i, pdgid, energy in zip(trackid, arrays['pdgid'].tolist(), arrays['energy'].tolist())
         )
-    G.add_edges_from(np.array(edges))
-    G.mylabels = labels
+    G.add_edges_from(arrays['trackid'][arrays['edges']].tolist())
+    G.mylabels = dict(zip(trackid, graph_labels(arrays)))
     return G
 
 
 # ____________________________________________________
 # Plotting
 
-def plot_graph(node, with_labels=True, labels=None, prog='twopi', ax=None):
+def plot_graph(node, with_labels=True, labels=None, prog='twopi', ax=None, collapse_depth=None, max_nodes=None):
+    '''
+    Draws the tree with a graphviz layout. Use collapse_depth or max_nodes (see
+    graph_arrays) to bound the layout time for large trees.
+    '''
     import networkx as nx
     import pygraphviz
     from networkx.drawing.nx_agraph import graphviz_layout
-    G = make_graph(node)
+    G = make_graph(node, collapse_depth=collapse_depth, max_nodes=max_nodes)
     labels = G.mylabels if labels else None
     pos = graphviz_layout(G, prog=prog, args='')
-    fig = plt.figure(figsize=(8, 8))
+    if ax is None: ax = plt.figure(figsize=(8, 8)).add_subplot(111)
     pdgids = np.array([d.get('pdgid', 0) for n, d in G.nodes(data=True)])
-    node_color = color_pdgid(pdgids)
+    node_color = ht.color_pdgid(pdgids)
     energies = np.array([d.get('energy', 10.) for n, d in G.nodes(data=True)])
     normed_energies = 100. * np.log(energies + 1.) / np.max(np.log(energies + 1.))
     nx.draw(
@@ -538,22 +738,94 @@ def plot_graph(node, with_labels=True, labels=None, prog='twopi', ax=None):
         alpha = 0.5,
         with_labels = with_labels,
         labels = labels,
-        **({} if ax is None else {'ax':ax})
+        ax = ax
         )
-    plt.axis('equal')
+    ax.axis('equal')
+
+
+def _track_colors(tracks, color_by_pdgid=True):
+    """
+    Returns an (n, 4) array of rgba colors for a list of tracks
+    """
+    from matplotlib.colors import to_rgba_array
+    if color_by_pdgid:
+        names = ht.color_pdgid(np.array([t.pdgid for t in tracks], dtype=np.int64))
+    else:
+        names = ht.color_for_id(np.array([t.trackid for t in tracks]))
+    # Convert every distinct color only once
+    unique, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+    return to_rgba_array(unique)[inverse.ravel()].reshape((-1, 4))
+
+
+def _track_points(tracks, attrs, flipz=1.):
+    """
+    Returns an (n, 3) array of getattr(track, attr) for the 3 attrs, with z multiplied by flipz
+    """
+    points = np.array([ [getattr(t, a) for a in attrs] for t in tracks ], dtype=np.float64).reshape((-1, 3))
+    points[:,2] *= flipz
+    return points
+
+
+def _plot_segments(ax, starts, ends, colors, linewidth):
+    """
+    Draws all line segments (start -> end, in x, y, z) as one Line3DCollection,
+    in the (z, x, y) plotting frame
+    """
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
+    segments = np.stack((starts, ends), axis=1)[:,:,[2, 0, 1]]
+    if len(segments) == 0: return
+    ax.auto_scale_xyz(segments[:,:,0], segments[:,:,1], segments[:,:,2], had_data=ax.has_data())
+    ax.add_collection3d(Line3DCollection(segments, colors=colors, linewidths=linewidth))
+
+
+def _label_selection(priority, max_labels=None):
+    """
+    Returns the indices of the `max_labels` entries with the highest priority
+    (all entries if max_labels is None)
+    """
+    order = np.argsort(-np.asarray(priority), kind='stable')
+    return order if max_labels is None else order[:max_labels]
 
 
-def plot_node(node, ax=None, labels=True, plot_hits=True, color_by_pdgid=True, scale_hitsize=True):
+def _plot_labels(ax, positions, texts, colors, alignment_z, priority, max_labels=None):
+    """
+    Draws text labels at positions (x, y, z), only for the `max_labels` entries with
+    the highest priority if max_labels is not None
+    """
+    for i in _label_selection(priority, max_labels):
+        ax.text(
+            positions[i,2], positions[i,0], positions[i,1],
+            texts[i],
+            color=colors[i],
+            fontsize=14,
+            horizontalalignment='left' if alignment_z[i] < 0. else 'right'
+            )
+
+
+def plot_node(
+    node, ax=None, labels=True, plot_hits=True, color_by_pdgid=True, scale_hitsize=True,
+    batched=True, max_labels=None, set_limits=None
+    ):
     """
     Plots tracks and hits. The negative endcap is flipped.
+    With batched=True, all tracks are drawn in one Line3DCollection and all hits in one
+    scatter; use batched=False to get one artist (and legend entry) per track.
+    If max_labels is set, only the labels of the max_labels most energetic tracks are drawn.
+    The endcap limits and axis labels are set if set_limits is True, or by default only
+    if no ax is passed.
     """
-    fresh_ax = False
+    if set_limits is None: set_limits = not ax
     if not ax:
-        fresh_ax = True
         fig = plt.figure(figsize=(24,24))
         ax = fig.add_subplot(111 , projection='3d')
 
-    for track in node.traverse():
+    if batched:
+        _plot_node_batched(node, ax, labels, plot_hits, color_by_pdgid, scale_hitsize, max_labels)
+    else:
+        tracks = list(node.traverse())
+        labelled = set(_label_selection([t.energy for t in tracks], max_labels))
+
+    for i_track, track in enumerate([] if batched else tracks):
         color = ht.color_pdgid(track.pdgid) if color_by_pdgid else ht.color_for_id(track.trackid)
         x_in, y_in, z_in = track.vertex_x, track.vertex_y, track.vertex_z
         x_out, y_out, z_out = track.x, track.y, track.z
@@ -576,7 +848,7 @@ def plot_node(node, ax=None, labels=True, plot_hits=True, color_by_pdgid=True, s
             linewidth = 0.5
             )
 
-        if labels:
+        if labels and i_track in labelled:
             ax.text(
                 z[-2], x[-2], y[-2],
                 r'$\mathbf{{{}}}_{{{},\,E={:.1f}}}$'.format(track.trackid, track.pdgid, track.energy),
@@ -585,24 +857,66 @@ def plot_node(node, ax=None, labels=True, plot_hits=True, color_by_pdgid=True, s
                 horizontalalignment='left' if z[-1] < 0. else 'right'
                 )
 
-    if fresh_ax:
-        pos_endcap = node.z > 0.        
-        if pos_endcap:
-            zmin = 0.
-            zmax = ht.HGCAL_ZMAX_POS
-        else:
-            zmin = ht.HGCAL_ZMIN_NEG
-            zmax = 0.
+    if set_limits: set_node_limits(ax, node)
+    return ax
 
-        max_xy_dim = 50.
-        ax.set_xlim(zmin, zmax)
-        ax.set_xlabel('z')
-        ax.set_ylabel('x')
-        ax.set_zlabel('y')
-        ax.set_ylim(-max_xy_dim, max_xy_dim)
-        ax.set_zlim(-max_xy_dim, max_xy_dim)
 
-    return ax
+def set_node_limits(ax, node, max_xy_dim=50.):
+    """
+    Sets the z-range of the endcap of node and the x/y limits and axis labels of
+    a plot_node axis
+    """
+    pos_endcap = node.z > 0.
+    if pos_endcap:
+        zmin = 0.
+        zmax = ht.HGCAL_ZMAX_POS
+    else:
+        zmin = ht.HGCAL_ZMIN_NEG
+        zmax = 0.
+    ax.set_xlim(zmin, zmax)
+    ax.set_xlabel('z')
+    ax.set_ylabel('x')
+    ax.set_zlabel('y')
+    ax.set_ylim(-max_xy_dim, max_xy_dim)
+    ax.set_zlim(-max_xy_dim, max_xy_dim)
+
+
+def _plot_node_batched(node, ax, labels, plot_hits, color_by_pdgid, scale_hitsize, max_labels):
+    tracks = list(node.traverse())
+    colors = _track_colors(tracks, color_by_pdgid)
+    vertex = _track_points(tracks, ('vertex_x', 'vertex_y', 'vertex_z'))
+    position = _track_points(tracks, ('x', 'y', 'z'))
+    boundary = _track_points(tracks, ('xAtBoundary', 'yAtBoundary', 'zAtBoundary'))
+    crossed = np.array([ bool(t.crossedBoundary) for t in tracks ], dtype=bool)
+
+    # vertex -> boundary -> position for crossing tracks, vertex -> position otherwise
+    _plot_segments(
+        ax,
+        np.concatenate((vertex[crossed], boundary[crossed], vertex[~crossed])),
+        np.concatenate((boundary[crossed], position[crossed], position[~crossed])),
+        np.concatenate((colors[crossed], colors[crossed], colors[~crossed])),
+        0.5
+        )
+    ax.scatter(
+        boundary[crossed,2], boundary[crossed,0], boundary[crossed,1],
+        c=colors[crossed], marker='x', s=35.
+        )
+
+    if plot_hits:
+        _, hits, index = columnar_hits(node)
+        # columnar_hits lists the tracks with hits in the same traverse order
+        track_index = np.flatnonzero([ t.nhits > 0 for t in tracks ])[index]
+        size_option = { 's' : 10000. * hits[:,3] } if scale_hitsize else {}
+        ax.scatter(hits[:,2], hits[:,0], hits[:,1], c=colors[track_index], **size_option)
+
+    if labels:
+        energy = np.array([ t.energy for t in tracks ])
+        _plot_labels(
+            ax,
+            np.where(crossed[:,None], boundary, vertex),
+            [ r'$\mathbf{{{}}}_{{{},\,E={:.1f}}}$'.format(t.trackid, t.pdgid, t.energy) for t in tracks ],
+            colors, position[:,2], energy, max_labels
+            )
 
 
 def plot_node_rotated(
@@ -616,13 +930,16 @@ def plot_node_rotated(
         zmax=None,
         ref_node=None,
         scale_hitsize=True,
-        plot_shower_axis=False
+        plot_shower_axis=False,
+        batched=True,
+        max_labels=None
         ):
     """
     Puts the given track on the z-axis (the part from vertex to boundary
     crossing, or position if the track does not cross a boundary).
     This makes it possible to zoom in much more on the specific track.
     The plotted x, y and z axes are in a rotated coordinate system.
+    batched and max_labels work like in plot_node (labels are prioritized by nhits).
     """
     if not ax:
         fig = plt.figure(figsize=(24,24))
@@ -665,7 +982,17 @@ def plot_node_rotated(
     max_longitudinal_dim = 0.
     
     total_nhits = 0;
-    for i_track, track in enumerate(traverse(node)):
+    if batched:
+        total_nhits, max_perpendicular_dim, max_longitudinal_dim = _plot_node_rotated_batched(
+            node, ax, rotate, origin, flipz, scale_large_norm, labels, plot_hits,
+            color_by_pdgid, scale_hitsize, plot_shower_axis, max_labels
+            )
+
+    else:
+        tracks = list(traverse(node))
+        labelled = set(_label_selection([t.nhits for t in tracks], max_labels))
+
+    for i_track, track in enumerate([] if batched else tracks):
         if plot_shower_axis and track.nhits == 0: continue
         total_nhits += track.nhits
         c = ht.color_pdgid(track.pdgid) if color_by_pdgid else ht.color_for_id(track.trackid)
@@ -724,7 +1051,7 @@ def plot_node_rotated(
             x,y,z = [vertex[0], position[0]], [vertex[1], position[1]], [vertex[2], position[2]]
         ax.plot(z, x, y, linewidth=1, c=c)
 
-        if labels:
+        if labels and i_track in labelled:
             ax.text(
                 z[-1], x[-1], y[-1],
                 r'$\mathbf{{{}}}_{{{},\,n={}}}$'.format(track.trackid, track.pdgid, track.nhits),
@@ -768,6 +1095,81 @@ def plot_node_rotated(
     return ax
 
 
+def _plot_node_rotated_batched(
+    node, ax, rotate, origin, flipz, scale_large_norm, labels, plot_hits,
+    color_by_pdgid, scale_hitsize, plot_shower_axis, max_labels
+    ):
+    """
+    Batched drawing for plot_node_rotated. Returns the total number of hits and the
+    maximum perpendicular and longitudinal dimensions.
+    """
+    tracks = [ t for t in traverse(node) if not(plot_shower_axis and t.nhits == 0) ]
+    colors = _track_colors(tracks, color_by_pdgid)
+    nhits = np.array([ t.nhits for t in tracks ], dtype=np.int64)
+    crossed = np.array([ bool(t.crossedBoundary) for t in tracks ], dtype=bool)
+    vertex = rotate(_track_points(tracks, ('vertex_x', 'vertex_y', 'vertex_z'), flipz) - origin)
+    unrotated_position = _track_points(tracks, ('x', 'y', 'z'), flipz) - origin
+    position_norm = np.linalg.norm(unrotated_position, axis=-1)
+    position = rotate(unrotated_position)
+    atbound = rotate(_track_points(tracks, ('xAtBoundary', 'yAtBoundary', 'zAtBoundary'), flipz) - origin)
+    has_hits = nhits > 0
+    centroid = np.array([ t.centroid for t in tracks if t.nhits > 0 ]).reshape((-1, 3))
+    centroid[:,2] *= flipz
+    rcentroid = np.full((len(tracks), 3), np.nan)
+    rcentroid[has_hits] = rotate(centroid - origin)
+
+    # Matplotlib rolls over the line to the other side if the value is too large;
+    # scale down such tracks (see plot_node_rotated)
+    if scale_large_norm:
+        large = position_norm > 1000.
+        d = position[large] - vertex[large]
+        position[large] = vertex[large] + d / np.linalg.norm(d, axis=-1)[:,None] * 500.
+
+    if plot_hits:
+        _, hits, index = columnar_hits(node)
+        track_index = np.flatnonzero(has_hits)[index]
+        positions = hits[:,:3].copy()
+        positions[:,2] *= flipz
+        positions = rotate(positions - origin)
+        size_option = { 's' : 10000. * hits[:,3] } if scale_hitsize else {}
+        ax.scatter(positions[:,2], positions[:,0], positions[:,1], c=colors[track_index], **size_option)
+        ax.scatter(
+            rcentroid[has_hits,2], rcentroid[has_hits,0], rcentroid[has_hits,1],
+            c=colors[has_hits], s=100., marker='*'
+            )
+
+    if plot_shower_axis:
+        # Shower axes from the boundary crossing (vertex if not crossing) to the hit centroid
+        starts = np.where(crossed[:,None], atbound, vertex)
+        _plot_segments(ax, starts, rcentroid, colors, 1)
+        ends = rcentroid
+    else:
+        ax.scatter(
+            atbound[crossed,2], atbound[crossed,0], atbound[crossed,1],
+            c=colors[crossed], marker='x', s=35.
+            )
+        _plot_segments(
+            ax,
+            np.concatenate((vertex[crossed], atbound[crossed], vertex[~crossed])),
+            np.concatenate((atbound[crossed], position[crossed], position[~crossed])),
+            np.concatenate((colors[crossed], colors[crossed], colors[~crossed])),
+            1
+            )
+        ends = position
+
+    if labels:
+        _plot_labels(
+            ax, ends,
+            [ r'$\mathbf{{{}}}_{{{},\,n={}}}$'.format(t.trackid, t.pdgid, t.nhits) for t in tracks ],
+            colors, ends[:,2], nhits, max_labels
+            )
+
+    if len(tracks) == 0: return 0, 0., 0.
+    max_perpendicular_dim = max(np.max(np.abs(vertex[:,:2])), np.max(np.abs(position[:,:2])))
+    max_longitudinal_dim = np.max(np.abs(position[:,2]))
+    return nhits.sum(), max_perpendicular_dim, max_longitudinal_dim
+
+
 # ____________________________________________________
 # Merging algos december
 
@@ -834,7 +1236,7 @@ class CachedDistFn():
         return self.cache[(t1, t2)]
 
     def remove(self, t):
-        for t1, t2 in self.cache:
+        for t1, t2 in list(self.cache.keys()):
             if t1 == t or t2 == t:
                 del self.cache[(t1, t2)]
 
@@ -844,18 +1246,244 @@ class CachedDistFn():
                 del self.cache[(t1, t2)]
 
 
-def make_rotation(axis, include_inverse=False, debug=False):
+class MergeLog(object):
     '''
-    Takes a 3D axis, and builds a rotation matrix such that
-    R.dot(v) will rotate v to a coordinate system where the z-axis
-    is aligned with the z-axis of `axis`
+    Records every candidate pair score computed during merging, and the merge decisions.
+
+    Clusters are identified by the sorted trackids of their merged tracks, so a log
+    recorded on one copy of a tree can be used on a fresh copy (see `replay_merging`).
+    A pair score is stored as (score, dz): (overlap, dz) for the overlap algo, and
+    (dist, nan) for the distance algo. The scores only depend on the cluster contents,
+    not on the thresholds, so they can be reused when only the thresholds change.
+    A log is only valid for the distance fn it was recorded with (changing e.g. the
+    f_moliere_radius values in `overlap` requires a new log).
+    '''
+    def __init__(self):
+        self.use_overlap_algo = None
+        self.i_run = -1
+        self.n_reused = 0
+        self.n_computed = 0
+        # Cluster table: cluster key -> index, and the flattened trackids per cluster
+        self.cluster_index = {}
+        self.cluster_offsets = [0]
+        self.cluster_trackids = []
+        # Pair scores
+        self.pair_index = {}
+        self.pair_node = []
+        self.pair_a = []
+        self.pair_b = []
+        self.pair_score = []
+        self.pair_dz = []
+        # Merge decisions
+        self.merge_run = []
+        self.merge_node = []
+        self.merge_a = []
+        self.merge_b = []
+        self.merge_score = []
+        self.merge_dz = []
+
+    def __len__(self):
+        return len(self.pair_score)
+
+    def new_run(self):
+        self.i_run += 1
+
+    def check_mode(self, use_overlap_algo):
+        '''
+        `use_overlap_algo` is the log_mode of the merge criterion: a bool for the
+        dist/overlap criteria, a string (e.g. the class name) for other criteria
+        '''
+        if not isinstance(use_overlap_algo, str): use_overlap_algo = bool(use_overlap_algo)
+        if self.use_overlap_algo is None:
+            self.use_overlap_algo = use_overlap_algo
+        elif self.use_overlap_algo != use_overlap_algo:
+            raise ValueError(
+                'MergeLog was recorded with use_overlap_algo={}, cannot use it with use_overlap_algo={}'
+                .format(self.use_overlap_algo, use_overlap_algo)
+                )
+
+    def get_cluster_index(self, track):
+        key = tuple(sorted(int(t.trackid) for t in track.merged_tracks))
+        if key not in self.cluster_index:
+            self.cluster_index[key] = len(self.cluster_offsets) - 1
+            self.cluster_trackids.extend(key)
+            self.cluster_offsets.append(len(self.cluster_trackids))
+        return self.cluster_index[key]
+
+    def lookup(self, t1, t2):
+        '''
+        Returns the logged (score, dz) for the pair, or None if the pair was never scored
+        '''
+        row = self.pair_index.get((self.get_cluster_index(t1), self.get_cluster_index(t2)), None)
+        if row is None: return None
+        self.n_reused += 1
+        return self.pair_score[row], self.pair_dz[row]
+
+    def record_pair(self, node, t1, t2, score, dz):
+        ia, ib = self.get_cluster_index(t1), self.get_cluster_index(t2)
+        self.pair_index[(ia, ib)] = len(self.pair_score)
+        self.pair_node.append(int(node.trackid))
+        self.pair_a.append(ia)
+        self.pair_b.append(ib)
+        self.pair_score.append(float(score))
+        self.pair_dz.append(float(dz))
+        self.n_computed += 1
+
+    def record_merge(self, node, ia, ib, score, dz):
+        '''
+        Records a merge of cluster `ib` into cluster `ia` (indices from `get_cluster_index`)
+        '''
+        self.merge_run.append(self.i_run)
+        self.merge_node.append(int(node.trackid))
+        self.merge_a.append(ia)
+        self.merge_b.append(ib)
+        self.merge_score.append(float(score))
+        self.merge_dz.append(float(dz))
+
+    def cluster_trackids_for(self, i_cluster):
+        return self.cluster_trackids[self.cluster_offsets[i_cluster]:self.cluster_offsets[i_cluster+1]]
+
+    def to_arrays(self):
+        '''
+        Returns the log as a dict of flat numpy arrays
+        '''
+        mode = self.use_overlap_algo
+        return {
+            'use_overlap_algo' : np.array([-1 if mode is None or isinstance(mode, str) else int(mode)]),
+            'mode' : np.array([mode if isinstance(mode, str) else '']),
+            'cluster_offsets' : np.array(self.cluster_offsets, dtype=np.int64),
+            'cluster_trackids' : np.array(self.cluster_trackids, dtype=np.int64),
+            'pair_node' : np.array(self.pair_node, dtype=np.int64),
+            'pair_a' : np.array(self.pair_a, dtype=np.int64),
+            'pair_b' : np.array(self.pair_b, dtype=np.int64),
+            'pair_score' : np.array(self.pair_score, dtype=np.float64),
+            'pair_dz' : np.array(self.pair_dz, dtype=np.float64),
+            'merge_run' : np.array(self.merge_run, dtype=np.int64),
+            'merge_node' : np.array(self.merge_node, dtype=np.int64),
+            'merge_a' : np.array(self.merge_a, dtype=np.int64),
+            'merge_b' : np.array(self.merge_b, dtype=np.int64),
+            'merge_score' : np.array(self.merge_score, dtype=np.float64),
+            'merge_dz' : np.array(self.merge_dz, dtype=np.float64),
+            }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        inst = cls()
+        use_overlap_algo = int(arrays['use_overlap_algo'][0])
+        inst.use_overlap_algo = None if use_overlap_algo == -1 else bool(use_overlap_algo)
+        if 'mode' in arrays and str(arrays['mode'][0]): inst.use_overlap_algo = str(arrays['mode'][0])
+        inst.cluster_offsets = arrays['cluster_offsets'].tolist()
+        inst.cluster_trackids = arrays['cluster_trackids'].tolist()
+        for i in range(len(inst.cluster_offsets)-1):
+            inst.cluster_index[tuple(inst.cluster_trackids_for(i))] = i
+        for key in [
+            'pair_node', 'pair_a', 'pair_b', 'pair_score', 'pair_dz',
+            'merge_run', 'merge_node', 'merge_a', 'merge_b', 'merge_score', 'merge_dz'
+            ]:
+            setattr(inst, key, arrays[key].tolist())
+        inst.pair_index = { (ia, ib) : row for row, (ia, ib) in enumerate(zip(inst.pair_a, inst.pair_b)) }
+        inst.i_run = max(inst.merge_run) if inst.merge_run else -1
+        return inst
+
+    def save(self, outfile):
+        outdir = osp.dirname(osp.abspath(outfile))
+        if not osp.isdir(outdir): os.makedirs(outdir)
+        np.savez_compressed(outfile, **self.to_arrays())
+
+    @classmethod
+    def load(cls, infile):
+        with np.load(infile) as arrays:
+            return cls.from_arrays(arrays)
+
+
+class Linkage(object):
+    '''
+    Merge hierarchy of the siblings of one leaf-parent (or the root).
+
+    `Z` is a scipy-style linkage matrix: row k merges clusters Z[k,0] and Z[k,1]
+    into a new cluster n+k, with score Z[k,2] and number of leaves Z[k,3].
+    The score is the overlap (higher merges first) for the overlap algo, and the
+    distance (lower merges first) otherwise. `dz` holds the longitudinal distance
+    per merge for the overlap algo. Leaf i is the cluster with representative track
+    `trackids[i]`, containing the tracks members[member_offsets[i]:member_offsets[i+1]].
+    Note the scores are not necessarily monotonic.
+    '''
+    def __init__(self, trackids, member_offsets, members, Z, dz, higher_is_better, threshold):
+        self.trackids = trackids
+        self.member_offsets = member_offsets
+        self.members = members
+        self.Z = Z
+        self.dz = dz
+        self.higher_is_better = higher_is_better
+        self.threshold = threshold
+
+    @classmethod
+    def from_history(cls, leaves, leaf_members, history, higher_is_better, threshold):
+        '''
+        Builds the linkage from a list of (survivor, merged, (score, dz)) merges among `leaves`.
+        `leaf_members` are the trackids of the merged tracks per leaf before the merging.
+        '''
+        n = len(leaves)
+        cluster_id = { id(leaf) : i for i, leaf in enumerate(leaves) }
+        size = [1 for i in range(n)]
+        Z = np.zeros((len(history), 4))
+        dz = np.full(len(history), np.nan)
+        for k, (c1, c2, metric) in enumerate(history):
+            i1, i2 = cluster_id[id(c1)], cluster_id[id(c2)]
+            size.append(size[i1] + size[i2])
+            Z[k] = [min(i1, i2), max(i1, i2), metric[0], size[-1]]
+            dz[k] = metric[1]
+            cluster_id[id(c1)] = n + k
+        return cls(
+            np.array([int(leaf.trackid) for leaf in leaves], dtype=np.int64),
+            np.cumsum([0] + [len(m) for m in leaf_members]).astype(np.int64),
+            np.array([trackid for m in leaf_members for trackid in m], dtype=np.int64),
+            Z, dz, higher_is_better, threshold
+            )
+
+    @property
+    def n(self):
+        return len(self.trackids)
+
+    def n_merges(self, threshold=None):
+        '''
+        Number of merges performed at `threshold`: the merging stops at the first merge that fails it
+        '''
+        if threshold is None: threshold = self.threshold
+        scores = self.Z[:,2]
+        fails = ~(scores > threshold) if self.higher_is_better else ~(scores < threshold)
+        return int(np.argmax(fails)) if fails.any() else len(scores)
+
+    def cut(self, threshold=None):
+        '''
+        Returns a cluster label (0..n_clusters-1) per leaf for `threshold`, in O(n)
+        '''
+        n, n_merges = self.n, self.n_merges(threshold)
+        labels = np.arange(n + n_merges)
+        for k in range(n_merges-1, -1, -1):
+            labels[int(self.Z[k,0])] = labels[n+k]
+            labels[int(self.Z[k,1])] = labels[n+k]
+        return np.unique(labels[:n], return_inverse=True)[1]
+
+    def partition(self, threshold=None):
+        '''
+        Returns the merged clusters at `threshold` as tuples of trackids
+        '''
+        labels = self.cut(threshold)
+        clusters = [ [] for i in range(labels.max()+1 if self.n else 0) ]
+        for i, label in enumerate(labels):
+            clusters[label].extend(self.members[self.member_offsets[i]:self.member_offsets[i+1]].tolist())
+        return [ tuple(c) for c in clusters ]
+
+
+def rotation_matrices(axis):
+    '''
+    Returns the rotation matrices Rx and Ry (around the x- and y-axis) such that
+    v.dot(Rx.T).dot(Ry.T) is v in a coordinate system where the z-axis is aligned with `axis`
     '''
-    # Build rotation matrix
     from numpy import sin, cos, arctan2, arcsin
     dx = arctan2(axis[1],axis[2])
     dy = -arcsin(axis[0] / np.linalg.norm(axis))
-    # logger.debug('Rotation angle x-axis: %s', dx)
-    # logger.debug('Rotation angle y-axis: %s', dy)
     Rx = np.array([
         [1., 0., 0.],
         [0., cos(dx), -sin(dx)],
@@ -866,10 +1494,17 @@ def make_rotation(axis, include_inverse=False, debug=False):
         [0., 1., 0.],
         [-sin(dy), 0., cos(dy)],
         ])
-    R = Rx.dot(Ry)
+    return Rx, Ry
+
+def make_rotation(axis, include_inverse=False, debug=False):
+    '''
+    Takes a 3D axis, and builds a rotation matrix such that
+    R.dot(v) will rotate v to a coordinate system where the z-axis
+    is aligned with the z-axis of `axis`
+    '''
+    Rx, Ry = rotation_matrices(axis)
     if debug:
-        logger.info('rotation for axis=%s:\ndx=%s, dy=%s,\nR=%s', axis, dx, dy, R)
-    # logger.debug('Rotation matrix:\n%s', R)
+        logger.info('rotation for axis=%s:\nR=%s', axis, Rx.dot(Ry))
     rotate = lambda v: v.dot(Rx.T).dot(Ry.T)
     if include_inverse:
         inv_rotate = lambda v: v.dot(Ry).dot(Rx)
@@ -1067,20 +1702,115 @@ def longitudinal_dist(t1, t2):
     # print(rb1[2], re1[2], rb2[2], re2[2])
     return rb2[2] - re1[2]
 
-def overlap(t1, t2, draw=False, use_numba=True):
-    if draw and use_numba:
-        logger.warning('Turning off use_numba since draw is active')
-        use_numba = False
-
-    if t2.energyAtBoundary > t1.energyAtBoundary: t1, t2 = t2, t1
+# Fraction of energy to compute the moliere radius with, for
+# 1 hadron + 1 electromagnetic, 2 hadrons, and 2 electromagnetic tracks
+F_MOLIERE_RADIUS = (.3, .75, .85)
 
+def i_f_moliere_radius(t1, t2):
+    '''Index in F_MOLIERE_RADIUS to use for a pair of tracks'''
     if t1.is_hadron != t2.is_hadron: # 1 hadron, 1 electromagnetic
-        f_moliere_radius = .3
+        return 0
     elif t1.is_hadron: # 2 hadrons
-        f_moliere_radius = .75
+        return 1
     else: # 2 electromagnetic
-        f_moliere_radius = .85
+        return 2
+
+
+class SiblingGeometry(object):
+    '''
+    Per-track geometry needed by `overlap`, computed once for a set of siblings and
+    stored in arrays (row i belongs to tracks[i]): the boundary position, centroid,
+    axis, q10/q90 points, rotation matrices, the moliere radius for every value in
+    `f_moliere_radius`, and the circle polygons of those radii around the centroid.
+    None of it depends on the other track in a pair, so only a newly merged cluster
+    needs to be recomputed (`update`). The tracks themselves are not modified.
+    '''
+    def __init__(self, tracks, f_moliere_radius=F_MOLIERE_RADIUS, n_circle=30):
+        self.tracks = list(tracks)
+        self.index = { id(t) : i for i, t in enumerate(self.tracks) }
+        self.f_moliere_radius = f_moliere_radius
+        n, nf = len(self.tracks), len(f_moliere_radius)
+        self.b = np.zeros((n, 3))
+        self.e = np.zeros((n, 3))
+        self.axis = np.zeros((n, 3))
+        self.v_q10 = np.zeros((n, 3))
+        self.v_q90 = np.zeros((n, 3))
+        self.Rx = np.zeros((n, 3, 3))
+        self.Ry = np.zeros((n, 3, 3))
+        self.r = np.zeros((n, nf))
+        # Circles around the centroid in the lab frame, and in the rotated frame of the track itself
+        self.circles = np.zeros((n, nf, n_circle, 3))
+        self.own_circles = np.zeros((n, nf, n_circle, 3))
+        # Index in f_moliere_radius for every pair (pdgids do not change when merging)
+        self.i_f_moliere_radius = ht.pdg.f_moliere_radius_matrix([t.pdgid for t in self.tracks])
+        for i, t in enumerate(self.tracks): self.compute(i, t)
+
+    def compute(self, i, t):
+        self.b[i], self.e[i], self.axis[i] = t.b, t.e, t.axis
+        self.v_q10[i], self.v_q90[i] = t.v_q10, t.v_q90
+        Rx, Ry = rotation_matrices(t.axis)
+        self.Rx[i], self.Ry[i] = Rx, Ry
+        re = (t.e-t.b).dot(Rx.T).dot(Ry.T)
+        for j, f in enumerate(self.f_moliere_radius):
+            self.r[i,j] = max(t.moliere_radius(f), 1.0)
+            circle = get_circle(self.r[i,j]).dot(Ry).dot(Rx)
+            self.circles[i,j] = circle + t.e
+            self.own_circles[i,j] = circle + re
+
+    def update(self, t):
+        '''Recomputes the geometry of a track (e.g. after merging other tracks into it)'''
+        self.compute(self.index[id(t)], t)
+
+    def rotate(self, i, v):
+        '''Rotates v to the coordinate system of track i'''
+        return v.dot(self.Rx[i].T).dot(self.Ry[i].T)
+
+
+def overlap_geometry(geometry, t1, t2, use_numba=True):
+    '''
+    Same as `overlap` (without drawing), but takes all per-track quantities from a
+    SiblingGeometry. Does not modify the tracks.
+    '''
+    if t2.energyAtBoundary > t1.energyAtBoundary: t1, t2 = t2, t1
+    i1, i2 = geometry.index[id(t1)], geometry.index[id(t2)]
+    j = geometry.i_f_moliere_radius[i1,i2]
+    o = geometry.b[i1]
+    rcircle1 = geometry.own_circles[i1,j]
+    rcircle2 = geometry.rotate(i1, geometry.circles[i2,j] - o)
+    if use_numba:
+        frac_2_in_1 = polygon_overlap_numba(rcircle1[:,:2], rcircle2[:,:2])
+    else:
+        frac_2_in_1 = polygon_overlap(rcircle1[:,:2], rcircle2[:,:2])
+    # Longitudinal distance between the q10-q90 segments, see `longitudinal_dist`
+    rb1 = geometry.rotate(i1, geometry.v_q10[i1]-o)
+    re1 = geometry.rotate(i1, geometry.v_q90[i1]-o)
+    rb2 = geometry.rotate(i1, geometry.v_q10[i2]-o)
+    re2 = geometry.rotate(i1, geometry.v_q90[i2]-o)
+    if rb2[2] < rb1[2]: rb1, re1, rb2, re2 = rb2, re2, rb1, re1
+    return frac_2_in_1, rb2[2] - re1[2]
+
+
+def overlap(t1, t2, draw=False, use_numba=True, geometry=None, fig=None):
+    '''
+    Returns the fraction of the moliere-radius circle of the lower energy track that
+    overlaps with the circle of the higher energy track (in the frame of the latter),
+    and the longitudinal distance between the tracks.
+    Without `draw`, the per-track quantities are taken from `geometry` (a SiblingGeometry
+    containing both tracks) or computed on the fly, and the tracks are not modified.
+    With `draw`, the diagnostic plots are drawn on `fig` (a new pyplot figure if None).
+    '''
+    if not draw:
+        if geometry is None: geometry = SiblingGeometry([t1, t2])
+        return overlap_geometry(geometry, t1, t2, use_numba=use_numba)
+
+    if use_numba:
+        logger.warning('Turning off use_numba since draw is active')
+        use_numba = False
+
+    if t2.energyAtBoundary > t1.energyAtBoundary: t1, t2 = t2, t1
+    f_moliere_radius = F_MOLIERE_RADIUS[i_f_moliere_radius(t1, t2)]
 
+    # The quantities below are set on the tracks only for the diagnostic plots
     for t in [t1, t2]:
         t.r = max(t.moliere_radius(f_moliere_radius), 1.0)
         t.rotate, t.inv_rotate = make_rotation(t.axis, include_inverse=True, debug=draw)
@@ -1122,18 +1852,18 @@ def overlap(t1, t2, draw=False, use_numba=True):
 
         logger.info(
             't1.q10=%s, t1.q90=%s, t1.v_q10=%s, t1.v_q90=%s',
-            t1._long_q10, t1._long_q90, t1._v_q10, t1._v_q90
+            t1.long_q10, t1.long_q90, t1.v_q10, t1.v_q90
             )
         logger.info(
             't2.q10=%s, t2.q90=%s, t2.v_q10=%s, t2.v_q90=%s',
-            t2._long_q10, t2._long_q90, t2._v_q10, t2._v_q90
+            t2.long_q10, t2.long_q90, t2.v_q10, t2.v_q90
             )
 
         frac_2_in_1, h = polygon_overlap(t1.rcircle[:,:2], t2.rcircle[:,:2], draw=draw)
 
         # Unrotated plot
         o = t1.b
-        fig = plt.figure(figsize=(24,36))
+        if fig is None: fig = plt.figure(figsize=(24,36))
         ax1 = fig.add_subplot(321 , projection='3d')
         ax2 = fig.add_subplot(322 , projection='3d')
         ax2.view_init(30, 60)
@@ -1198,24 +1928,41 @@ def overlap(t1, t2, draw=False, use_numba=True):
             weights = h['values'].flatten()
             )
 
-    elif use_numba:
-        frac_2_in_1 = polygon_overlap_numba(t1.rcircle[:,:2], t2.rcircle[:,:2])
-    else:
-        frac_2_in_1 = polygon_overlap(t1.rcircle[:,:2], t2.rcircle[:,:2])
 
     longd = longitudinal_dist(t1, t2)
+    # Don't leave the rotation closures on the tracks; they make the tree unpicklable
+    for t in [t1, t2]: del t.rotate, t.inv_rotate
     return frac_2_in_1, longd
 
 
+def canonical_key(track):
+    '''
+    Order of tracks that does not depend on the order of the tree: by energy
+    (descending), then by trackid
+    '''
+    return (-track.energy, int(track.trackid))
+
+
 def perform_merging_for_node(
     node, use_overlap_algo=False,
-    default_min_r=10., min_overlap = 0.5,
-    overlap_fn=None
+    default_min_r=10., min_overlap = 0.5, max_dz=10.,
+    overlap_fn=None, merge_log=None, linkage=None, criterion=None, deterministic=False
     ):
     """
     Looks at a track and its children, and decides which things to merge.
     `default_min_r` is the theshold up to which tracks will be merged, i.e.
     distances among tracks >default_min_r will not be merged.
+    The pairs are scored by `criterion` (a ht.criteria.MergeCriterion); if None, it
+    is made from the other arguments (see ht.criteria.from_legacy_kwargs).
+    If a `MergeLog` is passed, pair scores are looked up in it first, and
+    all newly computed pair scores and merge decisions are recorded in it.
+    If a dict is passed as `linkage`, the merging is continued past the threshold
+    to build the full `Linkage` for this node (stored under node.trackid), after
+    which the merges beyond the threshold are undone.
+    If `deterministic` is True, the result does not depend on the order of the
+    children: siblings are put in `canonical_key` order first, so that pairs are
+    scored in a fixed orientation and ties are broken in canonical order, and equal
+    energy merges keep the cluster with the lowest trackid.
     """
     logger.debug('Performing merging for leaf parent %s', node.trackid)
     # Check whether we're really in a leaf parent
@@ -1230,44 +1977,111 @@ def perform_merging_for_node(
     node.children = []
     # Also allow node itself to be merged if it has hits and is not the parent
     if not(node.is_root) and node.nhits > 0: children.append(node)
-    is_updated = False
-    
+    if deterministic: children.sort(key=canonical_key)
+    if criterion is None:
+        criterion = ht.criteria.from_legacy_kwargs(
+            use_overlap_algo, default_min_r, min_overlap, max_dz, overlap_fn
+            )
+    if merge_log is not None: merge_log.check_mode(criterion.log_mode)
+    build_linkage = linkage is not None and node.trackid not in linkage
+    leaves = list(children)
+    leaf_members = [ [int(t.trackid) for t in c.merged_tracks] for c in leaves ] if build_linkage else None
+    history = []
+
+    # Per-cluster state of the criterion and the pair scores are indexed by slot
+    # (position in the original list of children); merged away slots are unused
+    state = criterion.prepare(leaves)
+    slot = { id(c) : i for i, c in enumerate(leaves) }
+    # Deposited (hit) energy per cluster, for the 'energy' tie-break
+    deposited = lambda c: sum(h.energy for h in c.hits)
+    energy = np.array([ deposited(c) for c in leaves ], dtype=np.float64)
+    score_matrix = np.full((len(leaves), len(leaves)), np.nan)
+    aux_matrix = np.full((len(leaves), len(leaves)), np.nan)
+
+    def compute_scores(ia, ib):
+        """Scores the pairs of slots (ia[k], ib[k]), where ia[k] comes first in sibling order"""
+        score = np.full(len(ia), np.nan)
+        aux = np.full(len(ia), np.nan)
+        todo = np.ones(len(ia), dtype=bool)
+        if merge_log is not None:
+            for k in range(len(ia)):
+                logged = merge_log.lookup(leaves[ia[k]], leaves[ib[k]])
+                if logged is not None:
+                    score[k], aux[k] = logged
+                    todo[k] = False
+        if todo.any():
+            score[todo], aux[todo] = criterion.scores(state, ia[todo], ib[todo])
+            if merge_log is not None:
+                for k in np.flatnonzero(todo):
+                    merge_log.record_pair(node, leaves[ia[k]], leaves[ib[k]], score[k], aux[k])
+        score_matrix[ia, ib] = score_matrix[ib, ia] = score
+        aux_matrix[ia, ib] = aux_matrix[ib, ia] = aux
+
+    ia, ib = np.triu_indices(len(leaves), 1)
+    compute_scores(ia, ib)
+
     def merge(c1, c2, metric):
-        if c2.energy > c1.energy: c1, c2 = c2, c1
+        if deterministic:
+            if canonical_key(c2) < canonical_key(c1): c1, c2 = c2, c1
+        elif c2.energy > c1.energy:
+            c1, c2 = c2, c1
         logger.debug(
             'Merging {} into {}, metric={}'
             .format(c2.trackid, c1.trackid, metric)
             )
+        # Keep enough information to undo the merge
+        history.append((
+            c1, c2, metric, children.index(c2), len(c1.hits), len(c1.merged_tracks),
+            None if merge_log is None else (merge_log.get_cluster_index(c1), merge_log.get_cluster_index(c2))
+            ))
         c1.hits.extend(c2.hits)
         c1.merged_tracks.extend(c2.merged_tracks)
         children.remove(c2)
-        c1.update_hit_dependent_quantities()
+        c1.invalidate('hits')
+        # Only the pairs with the merged cluster need to be rescored
+        i1 = slot[id(c1)]
+        energy[i1] += energy[slot[id(c2)]]
+        criterion.update(state, i1, c1)
+        position = children.index(c1)
+        others = np.array([ slot[id(c)] for c in children ], dtype=np.int64)
+        before = np.arange(len(children)) < position
+        keep = np.arange(len(children)) != position
+        compute_scores(
+            np.where(before, others, i1)[keep], np.where(before, i1, others)[keep]
+            )
 
-    # Keep merging siblings as long as r < some_threshold, recalc r after every merge
-    while True:
-        current_max_overlap = (min_overlap, 0.)
-        min_r = default_min_r
-        to_merge = None
-        for c1, c2 in combinations(children, 2):
-            if use_overlap_algo:
-                overlap, dz = overlap_fn(c1, c2)
-                # Penalize overlap for non-hadron with hadron
-                # if c1.is_hadron != c2.is_hadron: overlap *= .6
-                if overlap > current_max_overlap[0] and dz < 10.:
-                    current_max_overlap = (overlap, dz)
-                    to_merge = (c1, c2)
-                    if overlap == 1.: break # It's not going to get larger anyway
-            else:
-                r = dist(c1, c2)
-                if r < min_r:
-                    min_r = r
-                    to_merge = (c1, c2)
-        if to_merge:
-            is_updated = True
-            merge(*to_merge, current_max_overlap if use_overlap_algo else min_r)
-            if use_overlap_algo and hasattr(overlap_fn, 'remove2'): overlap_fn.remove2(*to_merge)
-        else:
-            break
+    # Keep merging siblings as long as the best pair passes the threshold
+    # (When building the linkage, keep merging until no pair is left)
+    threshold = criterion.linkage_threshold if build_linkage else criterion.threshold
+    while len(children) > 1:
+        order = np.array([ slot[id(c)] for c in children ], dtype=np.int64)
+        pa, pb = np.triu_indices(len(order), 1)
+        ia, ib = order[pa], order[pb]
+        score, aux = score_matrix[ia, ib], aux_matrix[ia, ib]
+        k = criterion.select(score, aux, ia, ib, energy, threshold)
+        if k < 0: break
+        merge(leaves[ia[k]], leaves[ib[k]], (score[k], aux[k]))
+
+    # Number of merges that pass the threshold; the greedy merging stops at the first failing one
+    n_merges = 0
+    while n_merges < len(history) and criterion.passes(history[n_merges][2][0]): n_merges += 1
+    if build_linkage:
+        linkage[node.trackid] = Linkage.from_history(
+            leaves, leaf_members, [h[:3] for h in history],
+            criterion.higher_is_better, criterion.threshold
+            )
+    # Undo the merges beyond the threshold
+    for c1, c2, metric, index, nhits, nmerged, _ in reversed(history[n_merges:]):
+        del c1.hits[nhits:]
+        del c1.merged_tracks[nmerged:]
+        children.insert(index, c2)
+        c1.invalidate('hits')
+        energy[slot[id(c1)]] = deposited(c1)
+        criterion.undo(state, slot[id(c1)], c1)
+    if merge_log is not None:
+        for _, _, metric, _, _, _, (ia, ib) in history[:n_merges]:
+            merge_log.record_merge(node, ia, ib, *metric)
+    is_updated = n_merges > 0
 
     if node.is_root:
         # If the node was a root, the new merged children will just be set as an attribute
@@ -1293,6 +2107,7 @@ def perform_merging_for_node(
                 .format(children[0].trackid, children[0].pdgid, node.pdgid)
                 )
             children[0].pdgid = node.pdgid
+            children[0].invalidate('pdgid')
         node.parent.children.remove(node)
         node.parent.children.extend(children)
         return True
@@ -1309,13 +2124,19 @@ def traverse_only_leafparents(node):
         if all(len(child.children)==0 for child in node.children):
             yield node
 
-def merging_algo(root, inplace=False, progress=True, **kwargs):
+def merging_algo(root, inplace=False, progress=True, return_linkage=False, **kwargs):
     """
     Merging algorithm entrypoint
+    If `return_linkage` is True, returns (root, linkages), where linkages maps the
+    trackid of every merged leaf-parent (and 0 for the root) to its `Linkage`.
+    Other keyword arguments are passed to `perform_merging_for_node`; pass
+    deterministic=True for results that do not depend on the order of the tree.
     """
+    if return_linkage: kwargs['linkage'] = {}
     if not inplace: root = copy_tree(root)
     root.parent = None # Make sure root has no parent (in case of dealing with a subtree)
     trim_trivial_tracks(root, inplace=True)
+    if kwargs.get('merge_log', None) is not None: kwargs['merge_log'].new_run()
     i = 0
     maxdepth = root.maxdepth()
     if progress:
@@ -1335,31 +2156,200 @@ def merging_algo(root, inplace=False, progress=True, **kwargs):
         # print_dist(root, logger.debug)
         i += 1
     if progress: pbar.close()
-    return root
+    return (root, kwargs['linkage']) if return_linkage else root
 
 
 def merging_algo_overlap(root, **kwargs):
     '''
-    Shortcut for merging_algo fn above, with cached overlap function
+    Shortcut for merging_algo fn above, with the overlap function.
+    Unless a custom `overlap_fn` is passed, the overlap is computed from a
+    SiblingGeometry per leaf-parent, with cached pair results.
     '''
-    cached_dst = CachedDistFn(overlap)
     kwargs.setdefault('use_overlap_algo', True)
-    kwargs.setdefault('overlap_fn', cached_dst)
     return merging_algo(root, **kwargs)
 
 
+def replay_merging(root, merge_log, **kwargs):
+    '''
+    Re-runs the merging with (possibly different) thresholds, taking the pair scores
+    from `merge_log` wherever possible. Only pairs that were never scored before
+    are recomputed, and are added to the log.
+
+        log = MergeLog()
+        merged = merging_algo_overlap(root, merge_log=log)
+        for min_overlap in [.3, .4, .6]:
+            merged = replay_merging(root, log, min_overlap=min_overlap)
+    '''
+    if isinstance(merge_log.use_overlap_algo, bool):
+        kwargs.setdefault('use_overlap_algo', merge_log.use_overlap_algo)
+    kwargs['merge_log'] = merge_log
+    if kwargs.get('use_overlap_algo', False):
+        return merging_algo_overlap(root, **kwargs)
+    return merging_algo(root, **kwargs)
+
+
+def scan_merging(root, values, key='min_overlap', return_trees=False, merge_log=None, **kwargs):
+    '''
+    Runs the merging for a list of threshold values, e.g.
+
+        scan = scan_merging(root, [.3, .4, .5, .6], key='min_overlap', use_overlap_algo=True)
+        scan = scan_merging(root, [5., 10., 15.], key='default_min_r')
+
+    If `key` is None, `values` should be a list of dicts of merging kwargs.
+    The tree is trimmed once, and all grid points share one MergeLog, so every
+    distinct pair of clusters is only scored once for the whole scan.
+
+    Returns a dict with per grid point:
+    - 'partitions': list of merged clusters (tuples of trackids)
+    - 'n_clusters': cluster multiplicity (clusters with hits)
+    - 'containment': fraction of the deposited energy of every primary that ends
+      up in the cluster holding most of it (energy weighted over primaries)
+    - 'max_energy_fraction': fraction of the deposited energy in the leading cluster
+    '''
+    if merge_log is None: merge_log = MergeLog()
+    trimmed = trim_trivial_tracks(root)
+
+    # Per original track: deposited energy and the primary it descends from
+    primary_index = {}
+    deposited = {}
+    for i_primary, primary in enumerate(trimmed.children):
+        for track in primary.traverse():
+            primary_index[int(track.trackid)] = i_primary
+            deposited[int(track.trackid)] = sum(h.energy for h in track.hits)
+    total_deposited = sum(deposited.values())
+
+    scan = {
+        'values' : values, 'partitions' : [], 'n_clusters' : [],
+        'containment' : [], 'max_energy_fraction' : []
+        }
+    if return_trees: scan['trees'] = []
+    for value in values:
+        merge_kwargs = dict(kwargs, **(value if key is None else {key : value}))
+        merge_kwargs.setdefault('progress', False)
+        merged = replay_merging(trimmed, merge_log, **merge_kwargs)
+        clusters = [ t for t in merged.traverse() if t.nhits > 0 ]
+        partition = [ tuple(int(t.trackid) for t in c.merged_tracks) for c in clusters ]
+        # Contingency primary x cluster of deposited energy
+        contingency = np.zeros((len(trimmed.children), max(len(clusters), 1)))
+        for i_cluster, trackids in enumerate(partition):
+            for trackid in trackids:
+                contingency[primary_index[trackid], i_cluster] += deposited[trackid]
+        scan['partitions'].append(partition)
+        scan['n_clusters'].append(len(clusters))
+        scan['containment'].append(contingency.max(axis=1).sum() / total_deposited if total_deposited > 0. else 0.)
+        scan['max_energy_fraction'].append(contingency.sum(axis=0).max() / total_deposited if total_deposited > 0. else 0.)
+        if return_trees: scan['trees'].append(merged)
+    for k in ['n_clusters', 'containment', 'max_energy_fraction']:
+        scan[k] = np.array(scan[k])
+    scan['merge_log'] = merge_log
+    return scan
+
+
+def _prepare_outfile(outfile):
+    '''
+    Runs strftime formatting on outfile and creates its directory if needed
+    '''
+    from time import strftime
+    outfile = strftime(outfile)
+    directory = osp.dirname(outfile)
+    if directory and not osp.isdir(directory):
+        logger.info('Creating %s', directory)
+        os.makedirs(directory, exist_ok=True)
+    return outfile
+
+
 def savefig(*args, **kwargs):
     '''
     Wrapper around plt.savefig that always adds `bbox_inches='tight'`,
     creates the output directory if it doesn't exist, and runs strftime
     formatting on the path
     '''
-    from time import strftime
     args = list(args)
-    args[0] = strftime(args[0])
-    directory = osp.dirname(args[0])
-    if not osp.isdir(directory):
-        logger.info('Creating %s', directory)
-        os.makedirs(directory)
+    args[0] = _prepare_outfile(args[0])
     kwargs.setdefault('bbox_inches', 'tight')
     plt.savefig(*args, **kwargs)
+
+
+def _draw_node(fig, node, **kwargs):
+    # Same limits and labels as an interactive plot_node, so exports are comparable
+    kwargs.setdefault('set_limits', True)
+    return plot_node(node, ax=fig.add_subplot(111, projection='3d'), **kwargs)
+
+def _draw_node_rotated(fig, node, **kwargs):
+    return plot_node_rotated(node, ax=fig.add_subplot(111, projection='3d'), **kwargs)
+
+def _draw_graph(fig, node, **kwargs):
+    return plot_graph(node, ax=fig.add_subplot(111), **kwargs)
+
+def _draw_overlap(fig, t1, t2, **kwargs):
+    return overlap(t1, t2, draw=True, fig=fig, **kwargs)
+
+# kind -> (draw function taking a Figure as first argument, figsize)
+FIGURE_KINDS = {
+    'node' : (_draw_node, (24, 24)),
+    'node_rotated' : (_draw_node_rotated, (24, 24)),
+    'graph' : (_draw_graph, (8, 8)),
+    'overlap' : (_draw_overlap, (24, 36)),
+    }
+
+
+def render_figure(outfile, kind, args=(), kwargs=None, figsize=None, **savefig_kwargs):
+    '''
+    Draws one figure on its own Figure object with an Agg canvas (so without touching
+    the global pyplot state), and saves it to outfile (which is used as is; see
+    savefig_batch for the strftime formatting).
+    `kind` is a key of FIGURE_KINDS, or a function that takes the Figure as the first
+    argument, followed by *args and **kwargs.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import mpl_toolkits.mplot3d # Registers the 3d projection
+    default_figsize = None
+    if ht.is_string(kind): kind, default_figsize = FIGURE_KINDS[kind]
+    fig = Figure(figsize=figsize or default_figsize)
+    FigureCanvasAgg(fig)
+    kind(fig, *args, **(kwargs or {}))
+    savefig_kwargs.setdefault('bbox_inches', 'tight')
+    fig.savefig(outfile, **savefig_kwargs)
+    return outfile
+
+
+def _render_figure_job(job):
+    outfile, kind, args, kwargs, savefig_kwargs = job
+    try:
+        return render_figure(outfile, kind, args, kwargs, **savefig_kwargs)
+    except Exception:
+        logger.exception('Failed to render %s', outfile)
+        return None
+
+
+def savefig_batch(jobs, nworkers=None, progress=True, **savefig_kwargs):
+    '''
+    Renders many figures in a process pool. Every job is a tuple
+    (outfile, kind, args[, kwargs]), with kind and args as in `render_figure`, e.g.:
+
+        savefig_batch([
+            ('plots/%Y%m%d/node_{}.png'.format(i), 'node', (tree,), dict(labels=False))
+            for i, tree in enumerate(trees)
+            ])
+
+    Outfiles are strftime formatted (and their directories created) once, up front,
+    like in `savefig`. Every figure is drawn on its own Figure with the Agg canvas.
+    Arguments are pickled to the worker processes, so custom `kind` functions must
+    be defined at module level. nworkers=1 renders in this process.
+    Returns the list of written outfiles (None for jobs that failed).
+    '''
+    import multiprocessing
+    jobs = [
+        (_prepare_outfile(job[0]), job[1], tuple(job[2]), job[3] if len(job) > 3 else {}, savefig_kwargs)
+        for job in jobs
+        ]
+    if nworkers is None: nworkers = os.cpu_count()
+    if nworkers == 1 or len(jobs) <= 1:
+        iterator = map(_render_figure_job, jobs)
+        if progress: iterator = ht.tqdm(iterator, total=len(jobs))
+        return list(iterator)
+    with multiprocessing.Pool(min(nworkers, len(jobs))) as pool:
+        iterator = pool.imap(_render_figure_job, jobs)
+        if progress: iterator = ht.tqdm(iterator, total=len(jobs))
+        return list(iterator)
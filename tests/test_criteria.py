@@ -0,0 +1,89 @@
+import copy
+import numpy as np
+import pytest
+import devhgcaltruth as ht
+
+
+def make_tree(seed, nprim=4, nsec=6, hits_per=40):
+    '''Synthetic event: primaries with hits-depositing secondaries close to them'''
+    rng = np.random.RandomState(seed)
+    tracks = { k : [] for k in [
+        'trackid', 'parenttrackid', 'pdgid', 'energy', 'boundary_energy', 'crossedboundary',
+        'noparent', 'x', 'y', 'z', 'vertex_x', 'vertex_y', 'vertex_z',
+        'boundary_x', 'boundary_y', 'boundary_z', 'hashits',
+        ]}
+    hits = { k : [] for k in ['trackid', 'detid', 'x', 'y', 'z', 'energy'] }
+
+    def add(parent, pdgid, energy, sign, bx, by, nhits):
+        trackid = len(tracks['trackid']) + 1
+        for k, v in dict(
+            trackid=trackid, parenttrackid=parent, pdgid=pdgid, energy=energy,
+            boundary_energy=.9*energy, crossedboundary=1, noparent=int(parent == 0),
+            x=1.1*bx, y=1.1*by, z=sign*340., vertex_x=0., vertex_y=0., vertex_z=0.,
+            boundary_x=bx, boundary_y=by, boundary_z=sign*320.5, hashits=int(nhits > 0),
+            ).items():
+            tracks[k].append(v)
+        if nhits:
+            z = sign * (322. + rng.exponential(15., nhits))
+            scale = np.abs(z) / 320.5
+            x = bx*scale + rng.normal(0, 2., nhits)
+            y = by*scale + rng.normal(0, 2., nhits)
+            hits['trackid'].extend([trackid] * nhits)
+            hits['detid'].extend(np.arange(nhits) + 1000*trackid)
+            hits['x'].extend(x)
+            hits['y'].extend(y)
+            hits['z'].extend(z)
+            hits['energy'].extend(rng.exponential(.01, nhits))
+        return trackid
+
+    for i_prim in range(nprim):
+        sign = 1 if i_prim % 2 == 0 else -1
+        bx, by = rng.normal(0, 30, 2)
+        primary = add(
+            0, [22, 211, 11, 2212][i_prim % 4], rng.uniform(5, 50), sign, bx, by,
+            0 if i_prim % 3 == 0 else hits_per
+            )
+        for i_sec in range(nsec):
+            secondary = add(
+                primary, [22, 11, 211, 2112][i_sec % 4], rng.uniform(.5, 5), sign,
+                bx + rng.normal(0, 3), by + rng.normal(0, 3), hits_per//2
+                )
+            if i_sec % 3 == 0:
+                add(secondary, 22, .3, sign, bx + rng.normal(0, 3), by + rng.normal(0, 3), hits_per//4)
+    return ht.build_tree_from_columns(
+        { k : np.array(v) for k, v in tracks.items() },
+        { k : np.array(v) for k, v in hits.items() }
+        )
+
+
+def merged_labels(root, **kwargs):
+    merged = ht.trees.merging_algo(copy.deepcopy(root), progress=False, use_overlap_algo=True, **kwargs)
+    trackid, label, _ = ht.metrics.partition(merged)
+    return trackid, label
+
+
+@pytest.mark.parametrize('seed', [1, 7, 33])
+@pytest.mark.parametrize('min_overlap', [.3, .5])
+def test_cached_overlap_fn_matches_overlap(seed, min_overlap):
+    # The baseline merging_algo_overlap idiom: a CachedDistFn must be evicted after
+    # every merge and undo, or the grown cluster is scored with stale values
+    root = make_tree(seed)
+    expected = merged_labels(root, min_overlap=min_overlap, overlap_fn=ht.trees.overlap)
+    cached = merged_labels(root, min_overlap=min_overlap, overlap_fn=ht.trees.CachedDistFn(ht.trees.overlap))
+    geometry = merged_labels(root, min_overlap=min_overlap)
+    for result in [cached, geometry]:
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+
+
+def test_pair_fn_criterion_evicts_updated_track():
+    root = make_tree(1)
+    tracks = [ t for t in root.traverse() if t.nhits > 0 ][:3]
+    fn = ht.trees.CachedDistFn(ht.trees.dist)
+    criterion = ht.criteria.PairFnCriterion(fn, 10., higher_is_better=False)
+    state = criterion.prepare(tracks)
+    for a, b in [(0, 1), (0, 2), (1, 2)]: fn(tracks[a], tracks[b])
+    criterion.update(state, 0, tracks[0])
+    assert list(fn.cache.keys()) == [(tracks[1], tracks[2])]
+    criterion.undo(state, 1, tracks[1])
+    assert not fn.cache